@@ -0,0 +1,141 @@
+"""
+
+Description:
+    Benchmarks export-history.py and html-convert.py against the local
+    mock server (mock_server.py) with synthetic rooms. Reports wall time,
+    requests, bytes transferred and peak memory of the export, and the
+    render throughput of html-convert.py on the exported archive.
+
+Commands:
+    python bench/bench.py
+    python bench/bench.py --rooms 50 --days 365 --concurrency 4 --json report.json
+    python bench/bench.py --rate-limit 20 --history-format jsonl.gz
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from mock_server import add_workspace_arguments, start_server, workspace_from_args
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETTINGS = """[files]
+history_output_dir = ./history-files/
+history_statefile = state.pkl
+history_format = {history_format}
+file_prefix = /file-upload/
+file_folder = attachments
+avatar_folder = avatar
+month_blocks =
+
+[rc-api]
+auth = classic
+user = bench
+pass = bench
+server = {server}
+max_msg_count_per_day = 99999
+page_size = 100
+pause_seconds = 0
+max_requests_per_second = {max_rate}
+concurrency = {concurrency}
+download_concurrency = {download_concurrency}
+"""
+
+
+def run(command, cwd):
+    """Run command, returning wall time in seconds and peak RSS in MB"""
+    started = time.monotonic()
+    with open(os.path.join(cwd, 'bench-output.log'), 'ab') as log:
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise SystemExit('%s failed (exit %d), see %s' % (os.path.basename(command[1]),
+                                                          process.returncode,
+                                                          os.path.join(cwd, 'bench-output.log')))
+    # ru_maxrss is in kilobytes on Linux
+    return wall_time, usage.ru_maxrss / 1024
+
+
+def main():
+    argparser_main = argparse.ArgumentParser()
+    add_workspace_arguments(argparser_main)
+    argparser_main.add_argument('--concurrency', type=int, default=4,
+                                help='Rooms exported in parallel')
+    argparser_main.add_argument('--download-concurrency', type=int, default=4,
+                                help='Attachments downloaded in parallel')
+    argparser_main.add_argument('--max-rate', type=float, default=1000,
+                                help='max_requests_per_second of the exporter')
+    argparser_main.add_argument('--history-format', default='json',
+                                help='history_format of the exporter')
+    argparser_main.add_argument('--jobs', type=int, default=os.cpu_count(),
+                                help='Processes used by html-convert.py --all')
+    argparser_main.add_argument('--json', help='Also write the report to this file')
+    argparser_main.add_argument('--keep', action='store_true',
+                                help='Keep the working directory')
+    args = argparser_main.parse_args()
+
+    workspace = workspace_from_args(args)
+    server, url, stats = start_server(workspace, rate_limit=args.rate_limit)
+    messages = workspace.count()
+    print('Mock server on %s: %d rooms, %d messages' % (url, len(workspace.rooms), messages))
+
+    workdir = tempfile.mkdtemp(prefix='rocketchat-bench-')
+    os.makedirs(os.path.join(workdir, 'history-files', 'attachments'))
+    with open(os.path.join(workdir, 'settings.cfg'), 'w') as f:
+        f.write(SETTINGS.format(server=url, max_rate=args.max_rate,
+                                concurrency=args.concurrency,
+                                download_concurrency=args.download_concurrency,
+                                history_format=args.history_format))
+
+    try:
+        export_time, export_rss = run([sys.executable, os.path.join(REPO_DIR, 'export-history.py'),
+                                       'settings.cfg'], workdir)
+        export_stats = stats.report()
+
+        render_time, render_rss = run([sys.executable, os.path.join(REPO_DIR, 'html-convert.py'),
+                                       '--config', 'settings.cfg', '--all', '--offline',
+                                       '--jobs', str(args.jobs)], workdir)
+    finally:
+        server.shutdown()
+
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'workspace': {'rooms': len(workspace.rooms), 'messages': messages, 'days': args.days,
+                      'attachment_size': args.attachment_size, 'rate_limit': args.rate_limit},
+        'export': {'wall_time_s': round(export_time, 3),
+                   'requests': export_stats['requests'],
+                   'requests_by_endpoint': export_stats['requests_by_endpoint'],
+                   'throttled': export_stats['throttled'],
+                   'bytes_transferred': export_stats['bytes_sent'],
+                   'peak_rss_mb': round(export_rss, 1)},
+        'render': {'wall_time_s': round(render_time, 3),
+                   'messages_per_s': round(messages / render_time, 1) if render_time else None,
+                   'peak_rss_mb': round(render_rss, 1)},
+    }
+
+    print('export: %.2f s, %d requests (%d throttled), %.1f MB transferred, peak RSS %.1f MB'
+          % (export_time, export_stats['requests'], export_stats['throttled'],
+             export_stats['bytes_sent'] / 1e6, export_rss))
+    print('render: %.2f s, %.0f messages/s, peak RSS %.1f MB'
+          % (render_time, report['render']['messages_per_s'] or 0, render_rss))
+    if args.keep:
+        print('Output kept in ' + workdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+
+Description:
+    A stand-in for a Rocket.Chat server that serves synthetic rooms, for
+    benchmarking export-history.py without a live server. Implements the
+    parts of the REST API the exporter uses: login, the room lists,
+    *.history, chat.syncMessages, attachments (with ETag and Range) and
+    avatars. It can answer with rate limit errors the way Rocket.Chat
+    does (HTTP 429, X-RateLimit-* headers, 'error-too-many-requests').
+
+Commands:
+    python bench/mock_server.py --port 3000 --rooms 10 --days 60
+
+"""
+
+import json
+import time
+import random
+import argparse
+import datetime
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+BASE_DATE = datetime.datetime(2020, 1, 1)
+
+
+def rocketchat_timestamp(in_date):
+    return in_date.strftime(DATE_FORMAT)[:-4] + 'Z'
+
+
+class SyntheticWorkspace:
+    """Rooms with messages spread over a number of days. The same
+    arguments always give the same messages."""
+
+    def __init__(self, rooms=10, days=30, messages_per_day=20, users=8,
+                 attachment_every=25, attachment_size=50000, thread_every=15, seed=1):
+        self.attachment_size = attachment_size
+        self.rooms = []
+        self.messages = {}
+        rng = random.Random(seed)
+
+        for r in range(rooms):
+            room_id = 'room%04d' % r
+            messages = []
+            for day in range(days):
+                day_start = BASE_DATE + datetime.timedelta(days=day)
+                for ts in sorted(rng.uniform(0, 86400) for _ in range(rng.randint(0, 2 * messages_per_day))):
+                    i = len(messages)
+                    user = 'user%d' % rng.randrange(users)
+                    m = {'_id': '%s-m%d' % (room_id, i), 'rid': room_id,
+                         'msg': 'message %d of %s, *some* text' % (i, room_id),
+                         'ts': rocketchat_timestamp(day_start + datetime.timedelta(seconds=ts)),
+                         'u': {'_id': user, 'username': user, 'name': user.title()}}
+                    if attachment_every and i % attachment_every == attachment_every - 1:
+                        m['attachments'] = [{'title_link': '/file-upload/%s/file %d.png' % (room_id, i),
+                                             'image_type': 'image/png'}]
+                    if thread_every and i % thread_every == thread_every - 1 and i > 5:
+                        m['tmid'] = '%s-m%d' % (room_id, i - 5)
+                    m['_updatedAt'] = m['ts']
+                    messages.append(m)
+
+            self.messages[room_id] = messages
+            self.rooms.append({'_id': room_id, 'name': 'bench-%d' % r, 't': 'c',
+                               'ts': rocketchat_timestamp(BASE_DATE),
+                               'lm': messages[-1]['ts'] if messages else None})
+
+    def count(self):
+        return sum(len(messages) for messages in self.messages.values())
+
+
+class Stats:
+    """Requests and bytes served, per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.bytes_sent = 0
+        self.throttled = 0
+
+    def record(self, endpoint, size, throttled=False):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_sent += size
+            self.throttled += int(throttled)
+
+    def report(self):
+        with self._lock:
+            return {'requests': sum(self.requests.values()),
+                    'requests_by_endpoint': dict(self.requests),
+                    'bytes_sent': self.bytes_sent,
+                    'throttled': self.throttled}
+
+
+class RateLimiter:
+    """Fixed one second windows of at most limit requests, like the
+    Rocket.Chat API rate limiter"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._window = 0
+        self._count = 0
+
+    def check(self):
+        """(allowed, remaining, reset time in ms)"""
+        now = time.time()
+        with self._lock:
+            if int(now) != self._window:
+                self._window = int(now)
+                self._count = 0
+            self._count += 1
+            return (self._count <= self.limit, max(0, self.limit - self._count),
+                    (self._window + 1) * 1000)
+
+
+class MockRocketChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    workspace = None
+    stats = None
+    limiter = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, endpoint, code, body, headers=None, throttled=False):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.stats.record(endpoint, len(body), throttled)
+
+    def send_json(self, endpoint, data, code=200, headers=None, throttled=False):
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        self.send_body(endpoint, code, json.dumps(data).encode('utf-8'), headers, throttled)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.path.startswith('/api/v1/login'):
+            self.send_json('login', {'status': 'success',
+                                     'data': {'authToken': 'bench-token', 'userId': 'bench-user',
+                                              'me': {'username': 'bench'}}})
+        else:
+            self.send_json('unknown', {'success': False, 'error': 'unknown method'}, 404)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+
+        if url.path.startswith('/api/v1/'):
+            self.api(url.path[len('/api/v1/'):], query)
+        elif url.path.startswith('/file-upload/'):
+            self.file('attachment', self.workspace.attachment_size)
+        elif url.path.startswith('/avatar/'):
+            self.file('avatar', 2000)
+        else:
+            self.send_json('unknown', {}, 404)
+
+    def api(self, method, query):
+        headers = {}
+        if self.limiter is not None:
+            allowed, remaining, reset = self.limiter.check()
+            headers = {'X-RateLimit-Limit': str(self.limiter.limit),
+                       'X-RateLimit-Remaining': str(remaining),
+                       'X-RateLimit-Reset': str(reset)}
+            if not allowed:
+                wait = max(1, int(reset / 1000 - time.time() + 0.999))
+                self.send_json(method, {
+                    'success': False,
+                    'error': 'Error, too many requests. Please slow down. You must wait %d seconds '
+                             'before trying this endpoint again. [error-too-many-requests]' % wait},
+                    429, headers, throttled=True)
+                return
+
+        if method in ('channels.list.joined', 'groups.list', 'im.list'):
+            key = {'channels.list.joined': 'channels', 'groups.list': 'groups', 'im.list': 'ims'}[method]
+            rooms = self.workspace.rooms if key == 'channels' else []
+            offset = int(query.get('offset', 0))
+            count = min(100, int(query.get('count', 50)))
+            self.send_json(method, {key: rooms[offset:offset + count], 'offset': offset,
+                                    'count': len(rooms[offset:offset + count]),
+                                    'total': len(rooms), 'success': True}, headers=headers)
+
+        elif method.endswith('.history'):
+            messages = self.workspace.messages.get(query.get('roomId'), [])
+            oldest = query.get('oldest', '')
+            latest = query.get('latest', '9999')
+            # newest first, like the real API
+            selected = [m for m in reversed(messages) if oldest <= m['ts'] <= latest]
+            offset = int(query.get('offset', 0))
+            count = min(100, int(query.get('count', 20)))
+            self.send_json(method, {'messages': selected[offset:offset + count],
+                                    'success': True}, headers=headers)
+
+        elif method == 'chat.syncMessages':
+            self.send_json(method, {'result': {'updated': [], 'deleted': []}, 'success': True},
+                           headers=headers)
+
+        else:
+            self.send_json(method, {'success': False, 'error': 'unknown method'}, 404, headers)
+
+    def file(self, endpoint, size):
+        etag = '"%s-%d"' % (endpoint, size)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_body(endpoint, 304, b'', {'ETag': etag})
+            return
+
+        body = (self.path.encode('utf-8') * (size // max(1, len(self.path)) + 1))[:size]
+        headers = {'ETag': etag, 'Content-Type': 'image/png' if endpoint == 'attachment' else 'image/jpeg',
+                   'Accept-Ranges': 'bytes'}
+
+        byte_range = self.headers.get('Range', '')
+        if byte_range.startswith('bytes=') and byte_range.endswith('-'):
+            offset = int(byte_range[len('bytes='):-1])
+            if offset >= size:
+                self.send_body(endpoint, 416, b'', headers)
+                return
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (offset, size - 1, size)
+            self.send_body(endpoint, 206, body[offset:], headers)
+            return
+
+        self.send_body(endpoint, 200, body, headers)
+
+
+def start_server(workspace, port=0, rate_limit=0):
+    """Serve workspace on a background thread. Returns the server, its
+    URL and its Stats."""
+    stats = Stats()
+    handler = type('Handler', (MockRocketChatHandler,), {
+        'workspace': workspace,
+        'stats': stats,
+        'limiter': RateLimiter(rate_limit) if rate_limit else None,
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1], stats
+
+
+def add_workspace_arguments(argparser):
+    argparser.add_argument('--rooms', type=int, default=10, help='Number of rooms')
+    argparser.add_argument('--days', type=int, default=30, help='Days of history per room')
+    argparser.add_argument('--messages-per-day', type=int, default=20,
+                           help='Average number of messages per room and day')
+    argparser.add_argument('--attachment-every', type=int, default=25,
+                           help='Every n-th message has an attachment (0 for none)')
+    argparser.add_argument('--attachment-size', type=int, default=50000,
+                           help='Size of every attachment in bytes')
+    argparser.add_argument('--rate-limit', type=int, default=0,
+                           help='API requests per second before answering with '
+                                'error-too-many-requests (0 for no limit)')
+
+
+def workspace_from_args(args):
+    return SyntheticWorkspace(rooms=args.rooms, days=args.days,
+                              messages_per_day=args.messages_per_day,
+                              attachment_every=args.attachment_every,
+                              attachment_size=args.attachment_size)
+
+
+def main():
+    argparser_main = argparse.ArgumentParser()
+    argparser_main.add_argument('--port', type=int, default=3000)
+    add_workspace_arguments(argparser_main)
+    args = argparser_main.parse_args()
+
+    workspace = workspace_from_args(args)
+    server, url, stats = start_server(workspace, args.port, args.rate_limit)
+    print('Serving %d rooms with %d messages on %s' % (len(workspace.rooms), workspace.count(), url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(stats.report(), indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,8 @@ Author:
 """
 import datetime
 import pickle
+import sqlite3
+import urllib.parse
 import os
 import logging
 import pprint
@@ -36,11 +38,17 @@ import argparse
 import configparser
 import json
 import re
+import hashlib
 import requests
-import urllib
-import re
-from time import sleep
+import random
+import email.utils
+import threading
+import time
+import concurrent.futures
 from rocketchat_API.rocketchat import RocketChat
+from history_common import AttachmentDownloader, AttachmentManifest, attachment_diskname, \
+    make_session, HistoryArchive, JsonHistoryWriter, MessageIdIndex, load_history_file, try_lock, \
+    history_file_complete
 
 
 
@@ -57,6 +65,10 @@ TODAY = datetime.datetime.today()
 YESTERDAY = TODAY - ONE_DAY
 NULL_DATE = datetime.datetime(1, 1, 1, 0, 0, 0, 0)
 
+# room list API method per room type, and the room fields that are kept
+ROOM_LISTS = {'channels': 'channels_list_joined', 'ims': 'im_list', 'groups': 'groups_list'}
+ROOM_FIELDS = ('_id', 'name', 'fname', 'ts', 'lm', 'usersCount', 'usernames')
+
 
 #
 # Functions
@@ -78,6 +90,70 @@ def incr_by_day_or_month(in_date, month_block):
 
 
 
+def window_name(in_date, month_block):
+    """Name of the window (and history file prefix) that in_date falls into"""
+    if month_block:
+        return in_date.strftime('%Y-%m')+'-NN'
+    return in_date.strftime('%Y-%m-%d')
+
+
+def contiguous_runs(windows):
+    """Split a chronological list of (name, oldest, latest) windows into
+    runs without gaps between consecutive windows"""
+    runs = []
+    for window in windows:
+        if runs and runs[-1][-1][2] + datetime.timedelta(microseconds=1) == window[1]:
+            runs[-1].append(window)
+        else:
+            runs.append([window])
+    return runs
+
+
+def history_file_path(output_dir, outfilename, room_name):
+    """Path of the history file of a room for the window named outfilename"""
+    return output_dir + outfilename + '-' + re.sub(r'\s+', '_', room_name) + '.json'
+
+
+def parse_shard(value):
+    """Parse a '--shard' argument 'i/N' into (i - 1, N)"""
+    match = re.match(r'^(\d+)/(\d+)$', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError('expected i/N with 1 <= i <= N, e.g. 2/4')
+    return int(match.group(1)) - 1, int(match.group(2))
+
+
+def room_shard(room_id, shards):
+    """Shard (0 to shards - 1) a room belongs to. Based on a hash of the
+    room id, so it is the same on every machine and in every run."""
+    return int(hashlib.sha1(room_id.encode('utf-8')).hexdigest(), 16) % shards
+
+
+def shard_path(path, shard):
+    """Name of the per-shard copy of a state, index or metrics file:
+    'state.sqlite' becomes 'state.shard-2-of-4.sqlite'"""
+    base, ext = os.path.splitext(path)
+    return '%s.shard-%d-of-%d%s' % (base, shard[0] + 1, shard[1], ext)
+
+
+def merge_room(room, other):
+    """Combine two states of the same room, e.g. from the state of a shard.
+    The one that was exported further wins; the last message, last sync
+    and checkpoint are the latest of both."""
+    if room is None:
+        return dict(other)
+    merged = dict(other if other['lastsaved'] > room['lastsaved'] else room)
+    merged['lastmessage'] = max(room['lastmessage'], other['lastmessage'])
+    lastsync = [r['lastsync'] for r in (room, other) if r.get('lastsync')]
+    if lastsync:
+        merged['lastsync'] = max(lastsync)
+    checkpoints = [r for r in (room, other) if r.get('checkpoint')]
+    if checkpoints:
+        latest = max(checkpoints, key=lambda r: r['checkpoint'])
+        merged['checkpoint'] = latest['checkpoint']
+        merged['checkpoint_start'] = latest['checkpoint_start']
+    return merged
+
+
 def assemble_state(state_array, room_json, room_type, ims_name = None ):
     """Build the state_array that tracks what needs to be saved"""
     for channel in room_json[room_type]:
@@ -121,6 +197,46 @@ def assemble_state(state_array, room_json, room_type, ims_name = None ):
         state_array[channel['_id']]['lastmessage'] = lm
 
 
+def fetch_room_lists(rocket, rate, page_size, workers):
+    """Fetch the complete lists of joined channels, direct messages and
+    private groups, page by page. The first page of each list tells how
+    many rooms there are; the remaining pages are then fetched in parallel.
+    Only the room fields assemble_state needs are kept."""
+    def fetch(room_type, offset):
+        method = getattr(rocket, ROOM_LISTS[room_type])
+        data = rate.request(lambda: method(offset=offset, count=page_size),
+                            room_type + ' list').json()
+        # an error (e.g. an expired token) must not pass for an empty list
+        if not data.get('success'):
+            raise Exception('Untrapped error response from ' + room_type + ' list API: '
+                            + '{error_text}'
+                            .format(error_text=data.get('error')))
+        return data
+
+    def keep(rooms):
+        return [{key: room[key] for key in ROOM_FIELDS if key in room} for room in rooms]
+
+    room_lists = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(ROOM_LISTS), workers)) as pool:
+        first_pages = {room_type: pool.submit(fetch, room_type, 0) for room_type in ROOM_LISTS}
+        more_pages = []
+
+        for room_type, future in first_pages.items():
+            data = future.result()
+            rooms = data.get(room_type, [])
+            room_lists[room_type] = keep(rooms)
+            # the server may return fewer rooms per page than asked for
+            step = len(rooms)
+            if step:
+                for offset in range(step, data.get('total', step), step):
+                    more_pages.append((room_type, pool.submit(fetch, room_type, offset)))
+
+        for room_type, future in more_pages:
+            room_lists[room_type] += keep(future.result().get(room_type, []))
+
+    return room_lists
+
+
 def upgrade_state_schema(state_array, old_schema_version, logger):
     """Modify the datain the saved state file as needed for new versions"""
     cur_schema_version = old_schema_version
@@ -140,6 +256,1192 @@ def upgrade_state_schema(state_array, old_schema_version, logger):
         logger.debug('\n' + pprint.pformat(state_array))
 
 
+class RunMetrics:
+    """Counters and latency histograms of an export run.
+
+    Written at the end of the run as a JSON report and, if configured, as
+    a Prometheus textfile collector file. Every metric has a name and an
+    optional set of labels; histograms use the same buckets for all
+    durations.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+    PREFIX = 'rocketchat_export_'
+
+    def __init__(self, labels=None):
+        self.started = time.time()
+        self.labels = labels or {}
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.rooms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def count(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                key, {'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0})
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    def room(self, room_name, seconds, failed=False):
+        """Record how long the export of a room took"""
+        self.observe('room_duration_seconds', seconds)
+        with self._lock:
+            room = self.rooms.setdefault(room_name, {'messages': 0})
+            room['seconds'] = round(seconds, 3)
+            room['failed'] = failed
+
+    def room_messages(self, room_name, messages):
+        with self._lock:
+            self.rooms.setdefault(room_name, {'messages': 0})['messages'] += messages
+
+    def report(self, failed_rooms=()):
+        """The metrics as a dictionary, for the JSON report"""
+        def labelled(key):
+            return dict((('name', key[0]),) + key[1])
+
+        with self._lock:
+            return {
+                'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+                'labels': self.labels,
+                'duration_seconds': round(time.time() - self.started, 3),
+                'failed_rooms': sorted(failed_rooms),
+                'counters': [dict(labelled(key), value=value)
+                             for key, value in sorted(self.counters.items())],
+                'histograms': [dict(labelled(key), count=h['count'], sum=round(h['sum'], 3),
+                                    buckets=dict(zip([str(b) for b in self.BUCKETS], h['buckets'])))
+                               for key, h in sorted(self.histograms.items())],
+                'rooms': dict(sorted(self.rooms.items())),
+            }
+
+    def write_json(self, path, failed_rooms=()):
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.report(failed_rooms), f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def write_prometheus(self, path, failed_rooms=()):
+        """Write the metrics in the Prometheus text format. The file is
+        replaced atomically, as the textfile collector may read it at any
+        time. Per-room numbers are left out to keep the number of series
+        small; they are in the JSON report. The labels given to the
+        constructor (the shard of a sharded export) are added to every
+        series."""
+        def series(name, labels=(), extra=None):
+            labels = list(self.labels.items()) + list(labels) + list((extra or {}).items())
+            if not labels:
+                return self.PREFIX + name
+            return self.PREFIX + name + '{' + ','.join(
+                '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in labels) + '}'
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s%s counter' % (self.PREFIX, name))
+                    typed.add(name)
+                lines.append('%s %s' % (series(name, labels), value))
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s%s histogram' % (self.PREFIX, name))
+                    typed.add(name)
+                for bound, count in zip(self.BUCKETS, h['buckets']):
+                    lines.append('%s %d' % (series(name + '_bucket', labels, {'le': bound}), count))
+                lines.append('%s %d' % (series(name + '_bucket', labels, {'le': '+Inf'}), h['count']))
+                lines.append('%s %s' % (series(name + '_sum', labels), h['sum']))
+                lines.append('%s %d' % (series(name + '_count', labels), h['count']))
+
+        lines.append('# TYPE %slast_run_timestamp_seconds gauge' % self.PREFIX)
+        lines.append('%s %d' % (series('last_run_timestamp_seconds'), self.started))
+        lines.append('# TYPE %slast_run_duration_seconds gauge' % self.PREFIX)
+        lines.append('%s %.3f' % (series('last_run_duration_seconds'), time.time() - self.started))
+        lines.append('# TYPE %slast_run_failed_rooms gauge' % self.PREFIX)
+        lines.append('%s %d' % (series('last_run_failed_rooms'), len(failed_rooms)))
+
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+class RateLimitError(Exception):
+    """The server asked us to back off for longer than we are willing to wait"""
+
+
+class RateController:
+    """Adaptive request rate shared by all export workers.
+
+    Requests are admitted through a token bucket. The rate grows additively
+    after every successful request and is halved whenever the server
+    reports throttling (AIMD), so a run settles at the highest rate the
+    server accepts and recovers once throttling ends. The server's
+    X-RateLimit-* and Retry-After headers pause all workers until the
+    limit resets. Connection errors and 5xx responses are retried with
+    jittered exponential backoff.
+    """
+    INCREASE = 0.05   # requests/second added after each success
+    DECREASE = 0.5    # factor applied to the rate when throttled
+    BACKOFF_BASE = 1.0
+    BACKOFF_MAX = 60.0
+
+    def __init__(self, rate, max_rate, logger, max_retries=5, max_wait=900, metrics=None):
+        self.max_rate = max_rate
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.min_rate = min(rate, max_rate) / 10.0
+        self.rate = min(rate, max_rate)
+        self.logger = logger
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._tokens = 1.0
+        self._stamp = time.monotonic()
+        self._blocked_until = 0.0
+        # set to interrupt all waits, see _sleep
+        self.stop = threading.Event()
+
+    def _sleep(self, seconds):
+        if self.stop.wait(seconds):
+            raise Exception('Export interrupted')
+
+    def acquire(self):
+        """Block until the calling worker may issue its next request"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(max(1.0, self.rate),
+                                   self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                    reason = 'rate_limit'
+                elif self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                else:
+                    delay = (1.0 - self._tokens) / self.rate
+                    reason = 'pacing'
+            self.metrics.count('wait_seconds_total', {'reason': reason}, delay)
+            self._sleep(delay)
+
+    def estimate_seconds(self, requests, done=0):
+        """Time the token bucket needs to admit requests more requests after
+        done requests from now, if the server never throttles: the rate
+        grows by INCREASE after every request until it reaches max_rate.
+        Response times are not included."""
+        seconds = 0.0
+        rate = min(self.max_rate, self.rate + done * self.INCREASE)
+        while requests > 0 and rate < self.max_rate:
+            seconds += 1.0 / rate
+            rate = min(self.max_rate, rate + self.INCREASE)
+            requests -= 1
+        return seconds + max(0, requests) / self.max_rate
+
+    def hold(self, seconds):
+        """Keep every worker from starting a request for the next seconds"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def _success(self, response):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.INCREASE)
+
+        # pace ourselves to what is left of the current rate limit window
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            seconds_to_reset = parse_reset_header(reset)
+        except ValueError:
+            return
+        if remaining <= 0:
+            self.logger.debug('Rate limit exhausted, pausing %.1fs until it resets',
+                              seconds_to_reset)
+            self.hold(seconds_to_reset)
+        elif seconds_to_reset > 0:
+            with self._lock:
+                self.rate = max(self.min_rate,
+                                min(self.rate, remaining / seconds_to_reset))
+
+    def _throttled(self, seconds):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.DECREASE)
+        self.logger.warning('Rate limited by server: waiting %.1fs, rate lowered '
+                            'to %.2f requests/s', seconds, self.rate)
+        self.hold(seconds)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.BACKOFF_MAX,
+                                     self.BACKOFF_BASE * 2 ** (attempt - 1)))
+
+    def request(self, send, description, kind='api'):
+        """Issue a request through send() and return its response, waiting
+        for rate limits and retrying transient failures. kind ('api',
+        'attachment' or 'avatar') labels the request in the run metrics."""
+        attempt = 0
+        while True:
+            attempt += 1
+            self.acquire()
+            started = time.monotonic()
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as err:
+                self.metrics.count('requests_total', {'kind': kind, 'status': 'error'})
+                if attempt > self.max_retries:
+                    raise
+                self.metrics.count('retries_total', {'kind': kind, 'reason': 'connection'})
+                delay = self._backoff(attempt)
+                self.logger.warning('%s failed (%s), retry %d in %.1fs',
+                                    description, err, attempt, delay)
+                self._sleep(delay)
+                continue
+
+            self.metrics.observe('request_duration_seconds', time.monotonic() - started,
+                                 {'kind': kind})
+            self.metrics.count('requests_total', {'kind': kind, 'status': str(response.status_code)})
+
+            wait = throttle_wait(response)
+            if wait is not None:
+                # the body is not needed; closing a streamed response gives
+                # its connection back to the pool
+                response.close()
+                if wait > self.max_wait:
+                    raise RateLimitError('Unreasonable amount of time to wait for API '
+                                         'rate limit: %ds' % wait)
+                if attempt > self.max_retries:
+                    raise RateLimitError('Still rate limited after %d attempts: %s'
+                                         % (attempt, description))
+                self.metrics.count('retries_total', {'kind': kind, 'reason': 'rate_limited'})
+                self._throttled(wait)
+                continue
+
+            if response.status_code >= 500:
+                if attempt > self.max_retries:
+                    return response
+                response.close()
+                self.metrics.count('retries_total', {'kind': kind, 'reason': 'server_error'})
+                delay = self._backoff(attempt)
+                self.logger.warning('%s returned HTTP %d, retry %d in %.1fs',
+                                    description, response.status_code, attempt, delay)
+                self._sleep(delay)
+                continue
+
+            if kind == 'api':
+                # API responses are read completely by requests already
+                self.metrics.count('downloaded_bytes_total', {'kind': kind}, len(response.content))
+            self._success(response)
+            return response
+
+
+def parse_reset_header(value):
+    """Seconds from now until an X-RateLimit-Reset value, which Rocket.Chat
+    sends as epoch milliseconds (plain epoch seconds are accepted as well)"""
+    reset = float(value)
+    if reset > 1e11:
+        reset = reset / 1000.0
+    return max(0.0, reset - time.time())
+
+
+def throttle_wait(response):
+    """Return the seconds to wait if response is a rate limit error, else None"""
+    if response.status_code != 429:
+        # Rocket.Chat signals some rate limits only in the body
+        if response.status_code < 400 or 'error-too-many-requests' not in response.text:
+            return None
+
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(retry_after)
+                return max(0.0, when.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    reset = response.headers.get('X-RateLimit-Reset')
+    if reset:
+        try:
+            return parse_reset_header(reset)
+        except ValueError:
+            pass
+
+    seconds_search = re.search(r'must wait (\d+) seconds', response.text, re.IGNORECASE)
+    if seconds_search:
+        return float(seconds_search.group(1))
+
+    return RateController.BACKOFF_BASE
+
+
+class RoomLogger(logging.LoggerAdapter):
+    """Prefix log lines with the room name, as several rooms may be
+    exported at the same time"""
+    def process(self, msg, kwargs):
+        return '[%s] %s' % (self.extra['room'], msg), kwargs
+
+
+class AvatarCache:
+    """Avatars of message authors, kept on disk between runs.
+
+    Every user is looked at once per run at most. An avatar on disk is
+    trusted for 'ttl' seconds after it was last checked; after that it is
+    revalidated with a conditional request (If-None-Match /
+    If-Modified-Since), which costs no body transfer when it did not
+    change. Failed downloads are remembered for 'failure_ttl' seconds so
+    they are not retried for every message. The ETag, Last-Modified and
+    check times are kept in 'index.json' in the avatar folder.
+    """
+    INDEX = 'index.json'
+
+    def __init__(self, folder, server, session, rate, ttl, failure_ttl):
+        self.folder = folder
+        self.server = server
+        self.session = session
+        self.rate = rate
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.seen = set()
+        self._lock = threading.Lock()
+        self.index = {}
+
+        os.makedirs(folder, exist_ok=True)
+        index_path = os.path.join(folder, self.INDEX)
+        if os.path.isfile(index_path):
+            with open(index_path, encoding='utf-8') as f:
+                self.index = json.load(f)
+
+    def update(self, username, logger):
+        """Download or revalidate the avatar of username if it is due"""
+        with self._lock:
+            if username in self.seen:
+                return
+            self.seen.add(username)
+            entry = dict(self.index.get(username, {}))
+
+        diskpath = os.path.join(self.folder, username + '.jpg')
+        on_disk = os.path.isfile(diskpath)
+        age = time.time() - entry.get('checked', 0)
+
+        if entry.get('failed') and age < self.failure_ttl:
+            logger.debug('Avatar failed recently, not retrying: ' + username)
+            return
+        if on_disk and not entry.get('failed') and age < self.ttl:
+            logger.debug('Avatar on disk:' + username)
+            return
+
+        headers = {}
+        if on_disk:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            headers['If-Modified-Since'] = entry.get('last_modified') or \
+                email.utils.formatdate(os.path.getmtime(diskpath), usegmt=True)
+
+        req = self.rate.request(
+            lambda: self.session.get(self.server + '/avatar/' + username + '?format=jpeg',
+                                     headers=headers),
+            'avatar ' + username, kind='avatar')
+
+        entry['checked'] = time.time()
+        if req.status_code == 304:
+            logger.debug('Avatar unchanged: ' + username)
+            entry['failed'] = False
+        elif req.status_code == 200:
+            self.rate.metrics.count('downloaded_bytes_total', {'kind': 'avatar'}, len(req.content))
+            # named after the process, as other exports may share the folder
+            partpath = diskpath + '.%d.part' % os.getpid()
+            with open(partpath, 'wb') as fout:
+                fout.write(req.content)
+            os.replace(partpath, diskpath)
+            logger.debug('Downloaded avatar: ' + username)
+            entry['failed'] = False
+            entry['etag'] = req.headers.get('ETag')
+            entry['last_modified'] = req.headers.get('Last-Modified')
+        else:
+            logger.warning('Failed to download avatar: '+ username)
+            entry['failed'] = True
+
+        with self._lock:
+            self.index[username] = entry
+
+    def save(self):
+        """Write the index back to disk. Only the avatars looked at in this
+        run are updated, so what other exports into the same folder (other
+        shards) stored since it was loaded is kept."""
+        index_path = os.path.join(self.folder, self.INDEX)
+        tmp_path = index_path + '.%d.tmp' % os.getpid()
+        with self._lock:
+            index = {}
+            if os.path.isfile(index_path):
+                with open(index_path, encoding='utf-8') as f:
+                    index = json.load(f)
+            index.update((username, self.index[username])
+                         for username in self.seen if username in self.index)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+
+
+class StateStore:
+    """Export state kept in an SQLite database (WAL mode).
+
+    Holds the same per-room data as the old pickle state file, but every
+    change is committed right away: a room's 'lastsaved' is stored as soon
+    as the room is finished, and while a room is being exported the end of
+    each completed window is stored as its checkpoint. A run that is
+    interrupted therefore only loses the window it was working on, and the
+    next run resumes the room from its checkpoint.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS rooms (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL,
+            begintime TEXT NOT NULL,
+            lastmessage TEXT NOT NULL,
+            lastsaved TEXT NOT NULL,
+            checkpoint TEXT,
+            checkpoint_start TEXT,
+            lastsync TEXT
+        );
+        CREATE TABLE IF NOT EXISTS room_lists (
+            type TEXT PRIMARY KEY,
+            fetched_at TEXT NOT NULL,
+            rooms TEXT NOT NULL
+        );
+    """
+    ROOM_FIELDS = ('name', 'type', 'begintime', 'lastmessage', 'lastsaved')
+    DATE_FIELDS = ('begintime', 'lastmessage', 'lastsaved')
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        if readonly and not os.path.isfile(path):
+            path = ':memory:'
+        elif readonly:
+            path = 'file:' + urllib.parse.quote(os.path.abspath(path)) + '?mode=ro'
+        self.db = sqlite3.connect(path, uri=readonly, check_same_thread=False,
+                                  isolation_level=None)
+        if not readonly:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+        if path == ':memory:' or not readonly:
+            self.db.executescript(self.SCHEMA)
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(rooms)')]
+            if 'lastsync' not in columns:
+                self.db.execute('ALTER TABLE rooms ADD COLUMN lastsync TEXT')
+        # a database of an older version opened read-only lacks what
+        # later versions added
+        self.tables = [row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.columns = [row[1] for row in self.db.execute('PRAGMA table_info(rooms)')]
+
+    def is_empty(self):
+        return self.db.execute('SELECT COUNT(*) FROM rooms').fetchone()[0] == 0 and \
+            self.db.execute('SELECT COUNT(*) FROM meta').fetchone()[0] == 0
+
+    def load(self):
+        """Return the state as a room_state dictionary"""
+        room_state = {'_meta': {'schema_version': VERSION}}
+        for row in self.db.execute('SELECT key, value FROM meta'):
+            room_state['_meta'][row[0]] = json.loads(row[1])
+        lastsync = 'lastsync' if 'lastsync' in self.columns else 'NULL'
+        for row in self.db.execute('SELECT id, name, type, begintime, lastmessage, '
+                                   'lastsaved, checkpoint, checkpoint_start, ' + lastsync
+                                   + ' FROM rooms'):
+            room = dict(zip(self.ROOM_FIELDS, row[1:6]))
+            for field in self.DATE_FIELDS:
+                room[field] = datetime.datetime.fromisoformat(room[field])
+            if row[6] is not None:
+                room['checkpoint'] = datetime.datetime.fromisoformat(row[6])
+                room['checkpoint_start'] = datetime.datetime.fromisoformat(row[7])
+            if row[8] is not None:
+                room['lastsync'] = datetime.datetime.fromisoformat(row[8])
+            room_state[row[0]] = room
+        return room_state
+
+    def _write(self, sql, params=()):
+        if self.readonly:
+            return
+        with self._lock:
+            self.db.execute(sql, params)
+
+    def save_room(self, room_id, room):
+        """Store a room, dropping its checkpoint once it is finished"""
+        self._write('INSERT OR REPLACE INTO rooms (id, name, type, begintime, lastmessage, '
+                    'lastsaved, checkpoint, checkpoint_start, lastsync) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (room_id, room['name'], room['type'],
+                     room['begintime'].isoformat(), room['lastmessage'].isoformat(),
+                     room['lastsaved'].isoformat(),
+                     room['checkpoint'].isoformat() if room.get('checkpoint') else None,
+                     room['checkpoint_start'].isoformat() if room.get('checkpoint') else None,
+                     room['lastsync'].isoformat() if room.get('lastsync') else None))
+
+    def save(self, room_state):
+        """Store all rooms and the metadata in one transaction"""
+        if self.readonly:
+            return
+        with self._lock:
+            self.db.execute('BEGIN')
+            try:
+                for key, value in room_state.get('_meta', {}).items():
+                    self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                    (key, json.dumps(value)))
+                for room_id, room in room_state.items():
+                    if room_id != '_meta':
+                        self.db.execute(
+                            'INSERT INTO rooms (id, name, type, begintime, lastmessage, lastsaved) '
+                            'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET '
+                            'name=excluded.name, type=excluded.type, '
+                            'lastmessage=excluded.lastmessage, lastsaved=excluded.lastsaved',
+                            (room_id, room['name'], room['type'],
+                             room['begintime'].isoformat(), room['lastmessage'].isoformat(),
+                             room['lastsaved'].isoformat()))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def set_checkpoint(self, room_id, checkpoint, checkpoint_start):
+        """Record that room_id is exported up to checkpoint by a run that
+        started at checkpoint_start"""
+        self._write('UPDATE rooms SET checkpoint = ?, checkpoint_start = ? WHERE id = ?',
+                    (checkpoint.isoformat(), checkpoint_start.isoformat(), room_id))
+
+    def set_lastsync(self, room_id, lastsync):
+        """Record that the edits and deletions of room_id up to lastsync
+        are patched into its history files"""
+        self._write('UPDATE rooms SET lastsync = ? WHERE id = ?',
+                    (lastsync.isoformat(), room_id))
+
+    def merge(self, room_state, other_state, keep=None):
+        """Fold the rooms of other_state (the state of a shard, or the
+        state a shard started from) into room_state with merge_room, and
+        store them. keep(room_id), if given, selects the rooms to take."""
+        for room_id, room in other_state.items():
+            if room_id == '_meta' or (keep is not None and not keep(room_id)):
+                continue
+            room_state[room_id] = merge_room(room_state.get(room_id), room)
+            self.save_room(room_id, room_state[room_id])
+
+    def load_room_lists(self, max_age):
+        """The room lists stored by save_room_lists, if they are all younger
+        than max_age (a timedelta), else None"""
+        if 'room_lists' not in self.tables:
+            return None
+        room_lists = {}
+        oldest = datetime.datetime.now() - max_age
+        for room_type, fetched_at, rooms in self.db.execute(
+                'SELECT type, fetched_at, rooms FROM room_lists'):
+            if datetime.datetime.fromisoformat(fetched_at) < oldest:
+                return None
+            room_lists[room_type] = json.loads(rooms)
+        if set(room_lists) != set(ROOM_LISTS):
+            return None
+        return room_lists
+
+    def save_room_lists(self, room_lists):
+        """Keep the room lists of the server, to save fetching them again
+        for a while"""
+        fetched_at = datetime.datetime.now().isoformat()
+        for room_type, rooms in room_lists.items():
+            self._write('INSERT OR REPLACE INTO room_lists (type, fetched_at, rooms) VALUES (?, ?, ?)',
+                        (room_type, fetched_at, json.dumps(rooms)))
+
+    def import_pickle(self, state_file, logger):
+        """Take over the state of the old pickle state file"""
+        if self.readonly:
+            logger.info('Reading state from %s (read-only, not migrating it)', state_file)
+        else:
+            logger.info('Migrating state from %s to %s', state_file, self.path)
+        with open(state_file, 'rb') as sf:
+            room_state = pickle.load(sf)
+        schema_version = 1.0 if '_meta' not in room_state else room_state['_meta']['schema_version']
+        if schema_version < VERSION:
+            upgrade_state_schema(room_state, schema_version, logger)
+        room_state['_meta']['migrated_from'] = state_file
+        self.save(room_state)
+        return room_state
+
+
+class RoomExporter:
+    """Exports the history of single rooms, window by window.
+
+    One instance is shared by all workers; everything that is specific to
+    a room lives in the local variables of export_room.
+    """
+    def __init__(self, rocket, rate, downloader, avatars, state, logger, settings):
+        self.rocket = rocket
+        self.state = state
+        self.rate = rate
+        self.downloader = downloader
+        self.avatars = avatars
+        self.logger = logger
+        self.settings = settings
+        # page lengths seen so far, see last_page
+        self._page_lock = threading.Lock()
+        self.longest_page = 0
+        self.probed_pages = set()
+        # set when the run is interrupted, see check_stop; shared with the
+        # rate controller, so waits for the request budget end as well
+        self.stop = rate.stop
+
+    def export_room(self, channel_id, channel_data):
+        """Fetch all windows of a room, oldest first"""
+        started = time.monotonic()
+        failed = True
+        try:
+            self._export_room(channel_id, channel_data)
+            failed = False
+        finally:
+            self.rate.metrics.room(channel_data['name'], time.monotonic() - started, failed)
+
+    def _export_room(self, channel_id, channel_data):
+        logger = RoomLogger(self.logger, {'room': channel_data['name']})
+        start_time = self.settings['start_time']
+        end_time = self.settings['end_time']
+
+        logger.info('------------------------')
+        logger.info('Processing room: ' + channel_id + ' - ' + channel_data['name'])
+
+        logger.debug('Global start time: %s', str(start_time))
+        logger.debug('Global end time: %s', str(end_time))
+        logger.debug('Room start ts: %s', str(channel_data['begintime']))
+        logger.debug('Last message: %s', str(channel_data['lastmessage']))
+        logger.debug('Last saved: %s ', str(channel_data['lastsaved']))
+
+        run_start, windows = self.plan_windows(channel_data, logger)
+
+        # the room is only recorded as saved (and checkpointed) up to where
+        # its attachments are on disk, see checkpoint
+        checkpoints = []
+        for run in contiguous_runs(windows):
+            self.export_windows(channel_id, channel_data, run, run_start, checkpoints, logger)
+        if checkpoints:
+            logger.info('Waiting for the attachment downloads of the room')
+            concurrent.futures.wait([f for futures, _ in checkpoints for f in futures])
+            self.checkpoint(channel_id, run_start, checkpoints)
+        self.check_stop()
+
+        if self.settings['delta_sync']:
+            self.sync_room(channel_id, channel_data, logger)
+
+        logger.info('------------------------\n')
+
+    def plan_windows(self, channel_data, logger):
+        """Work out which windows of a room an export fetches, without
+        requesting anything. Returns (run_start, windows), where windows is
+        a chronological list of (name, oldest, latest) and run_start the
+        start the checkpoint of this run refers to."""
+        start_time = self.settings['start_time']
+        end_time = self.settings['end_time']
+        month_block = self.settings['month_block']
+        skip_if_file_exists = self.settings['skip_if_file_exists']
+
+        if start_time is not None:
+            # use globally specified start time but if the start time
+            # is before the channel existed, fast-forward to its creation
+            t_oldest = channel_data['begintime'] if channel_data['begintime'] > start_time \
+            else start_time
+        elif channel_data['lastsaved'] != NULL_DATE:
+            # no global override for start time, so use a tick after
+            # the last saved date if it exists
+            t_oldest = channel_data['lastsaved'] + datetime.timedelta(microseconds=1)
+        else:
+            # nothing specified at all so use the beginning time of the channel
+            t_oldest = channel_data['begintime']
+
+        if month_block:
+            t_oldest = t_oldest.replace(day=1)
+            logger.info('Month mode: grabbing messages in blocks of months')
+
+        # an earlier run that covered the same start was interrupted after
+        # exporting some windows: carry on after the last one it finished
+        run_start = t_oldest
+        checkpoint = channel_data.get('checkpoint')
+        if checkpoint and channel_data['checkpoint_start'] <= t_oldest <= checkpoint:
+            run_start = channel_data['checkpoint_start']
+            t_oldest = checkpoint + datetime.timedelta(microseconds=1)
+            logger.info('Resuming after checkpoint ' + str(checkpoint))
+
+        if (t_oldest < end_time) and (t_oldest < channel_data['lastmessage']):
+            logger.info('Grabbing messages since '
+                        + str(t_oldest)
+                        + ' through '
+                        + str(end_time))
+        else:
+            logger.info('Nothing to grab between '
+                        + str(t_oldest)
+                        + ' through '
+                        + str(end_time))
+
+        # plan the windows (one per day, or per month in month mode) that
+        # need to be exported; each becomes one history file
+        windows = []
+        while (t_oldest < end_time) and (t_oldest < channel_data['lastmessage']):
+            outfilename = window_name(t_oldest, month_block)
+            t_next = incr_by_day_or_month( t_oldest, month_block)
+
+            if skip_if_file_exists and self.window_exists(outfilename, channel_data['name']):
+                logger.info('skipping %s (as history file already exists) '+outfilename, get_rocketchat_timestamp(t_oldest))
+            else:
+                windows.append((outfilename, t_oldest, t_next - datetime.timedelta(microseconds=1)))
+            t_oldest = t_next
+
+        return run_start, windows
+
+    def plan_requests(self, windows):
+        """Fewest and most history requests export_windows needs for the
+        planned windows of a room, not counting the extra pages of windows
+        with more than page_size messages. Adaptive windows fetch a quiet
+        run of windows with one request; if every span turns out to be busy,
+        a run of n windows is split down to single windows, which takes
+        n - 1 span requests and n window requests."""
+        if not self.settings['adaptive_windows']:
+            fewest = most = len(windows)
+        else:
+            runs = contiguous_runs(windows)
+            fewest = len(runs)
+            most = sum(2 * len(run) - 1 for run in runs)
+        if self.settings['delta_sync']:
+            fewest += 1
+            most += 1
+        return fewest, most
+
+    def export_windows(self, channel_id, channel_data, windows, run_start, checkpoints, logger):
+        """Export a contiguous, chronological list of windows.
+
+        With adaptive_windows, the whole span is queried at once first. If it
+        holds less than a page of messages they are sorted into the windows
+        on our side, otherwise the span is split in half and each half is
+        handled the same way. Quiet stretches of a room thus cost a single
+        request instead of one per day. A single window that is still too
+        busy is paged through by export_window.
+
+        The state store gets a checkpoint after every finished window or span
+        (see checkpoint).
+        """
+        if len(windows) == 1 or not self.settings['adaptive_windows']:
+            for outfilename, t_oldest, t_latest in windows:
+                self.check_stop()
+                futures = self.export_window(channel_id, channel_data, outfilename,
+                                             t_oldest, t_latest, logger)
+                checkpoints.append((futures, t_latest))
+                self.checkpoint(channel_id, run_start, checkpoints)
+            return
+
+        self.check_stop()
+        t_oldest = windows[0][1]
+        t_latest = windows[-1][2]
+        logger.info('span: %s - %s (%d windows)', get_rocketchat_timestamp(t_oldest),
+                    get_rocketchat_timestamp(t_latest), len(windows))
+
+        messages = self.history_page(channel_id, channel_data, t_oldest, t_latest, 0, logger)
+
+        if not self.last_page(messages, lambda: self.history_page(
+                channel_id, channel_data, t_oldest, t_latest, len(messages), logger), logger):
+            half = len(windows) // 2
+            logger.debug('span is busy, splitting it into %d + %d windows',
+                         half, len(windows) - half)
+            self.export_windows(channel_id, channel_data, windows[:half], run_start, checkpoints, logger)
+            self.export_windows(channel_id, channel_data, windows[half:], run_start, checkpoints, logger)
+            return
+
+        by_window = {}
+        for m in messages:
+            outfilename = window_name(datetime.datetime.strptime(m['ts'], DATE_FORMAT),
+                                      self.settings['month_block'])
+            by_window.setdefault(outfilename, []).append(m)
+
+        futures = []
+        for outfilename, t_window_oldest, t_window_latest in windows:
+            page = by_window.get(outfilename)
+            if page:
+                logger.info('start: %s', get_rocketchat_timestamp(t_window_oldest))
+                futures += self.write_window(channel_data, outfilename, [page], logger)
+                logger.info('end: %s', get_rocketchat_timestamp(t_window_latest))
+
+        checkpoints.append((futures, t_latest))
+        self.checkpoint(channel_id, run_start, checkpoints)
+
+    def checkpoint(self, channel_id, run_start, checkpoints):
+        """Record how far a room is exported. checkpoints lists (futures,
+        t_latest) of the finished windows and spans, oldest first; the
+        checkpoint only moves past one once the attachment downloads it
+        queued (futures) are done, so a crash never leaves an attachment
+        behind that the next run would not fetch again."""
+        # downloads are cancelled when the run is interrupted
+        self.check_stop()
+        reached = None
+        while checkpoints and all(f.done() for f in checkpoints[0][0]):
+            reached = checkpoints.pop(0)[1]
+        if reached is not None:
+            self.state.set_checkpoint(channel_id, reached, run_start)
+
+    def check_stop(self):
+        """Give up on the room if the run was interrupted (Ctrl-C)"""
+        if self.stop.is_set():
+            raise Exception('Export interrupted')
+
+    def export_window(self, channel_id, channel_data, outfilename, t_oldest, t_latest, logger):
+        """Export a single window, paging through its messages. Returns the
+        futures of the attachment downloads it queued."""
+        logger.info('')
+        logger.info('start: %s', get_rocketchat_timestamp(t_oldest))
+        futures = self.write_window(
+            channel_data, outfilename,
+            self.history_pages(channel_id, channel_data, t_oldest, t_latest, logger), logger)
+        logger.info('end: %s', get_rocketchat_timestamp(t_latest))
+        logger.info('')
+        return futures
+
+    def write_window(self, channel_data, outfilename, pages, logger):
+        """Download what the messages of a window refer to and write them to
+        its history file. Each page is written out as soon as it arrives, so
+        memory use does not depend on how busy the room was in this window.
+        The file only takes the place of an earlier one once all pages are
+        written; if fetching a page fails, the earlier file is kept.
+        Returns the futures of the attachment downloads it queued."""
+        num_messages = 0
+        outfile = None
+        write_time = 0.0
+        futures = []
+
+        try:
+            for page in pages:
+                futures += self.download_attachments(page, logger)
+                self.download_avatars(page, logger)
+
+                started = time.monotonic()
+                if outfile is None:
+                    outfile = self.open_window(outfilename, channel_data['name'])
+
+                for m in page:
+                    outfile.write(m)
+                    num_messages += 1
+                write_time += time.monotonic() - started
+
+                if self.settings['message_index'] is not None:
+                    self.settings['message_index'].add(page, channel_data['name'])
+        except BaseException:
+            if outfile is not None:
+                outfile.abort()
+            raise
+
+        if outfile is not None:
+            started = time.monotonic()
+            outfile.close()
+            write_time += time.monotonic() - started
+            self.rate.metrics.observe('disk_write_seconds', write_time)
+            self.rate.metrics.count('history_files_written_total')
+
+        self.rate.metrics.count('messages_written_total', value=num_messages)
+        self.rate.metrics.room_messages(channel_data['name'], num_messages)
+        logger.info('Messages found: %s', str(num_messages))
+        return futures
+
+    def sync_room(self, channel_id, channel_data, logger):
+        """Patch the messages of a room that were edited or deleted since
+        the last sync into the history files already on disk.
+
+        chat.syncMessages returns every message updated since a point in
+        time, and the ids of deleted messages. Updated messages are put
+        into the window their timestamp belongs to; deleted ones are found
+        through the message id index. Only windows that have a history file
+        are rewritten, the others are left to the regular export.
+        """
+        sync_time = self.settings['sync_time']
+        since = channel_data.get('lastsync')
+        if since is None and channel_data['lastsaved'] != NULL_DATE:
+            # never synced: changes made since the room was last exported
+            since = channel_data['lastsaved']
+        if since is None:
+            channel_data['lastsync'] = sync_time
+            self.state.set_lastsync(channel_id, sync_time)
+            return
+
+        logger.info('Syncing changes since %s', get_rocketchat_timestamp(since))
+        response = self.rate.request(
+            lambda: self.rocket.call_api_get('chat.syncMessages', roomId=channel_id,
+                                             lastUpdate=get_rocketchat_timestamp(since)),
+            'sync of ' + channel_data['name'])
+        sync_data = response.json()
+
+        if not sync_data.get('success'):
+            error_text = sync_data.get('error')
+            logger.error('Error response from API endpoint: %s', error_text)
+            raise Exception('Untrapped error response from sync API: '
+                            + '{error_text}'
+                            .format(error_text=error_text))
+
+        updated = sync_data['result'].get('updated', [])
+        deleted = [d['_id'] for d in sync_data['result'].get('deleted', [])]
+        month_block = self.settings['month_block']
+        message_index = self.settings['message_index']
+        room_name = channel_data['name']
+
+        # window -> (updated messages by id, ids of deleted messages)
+        changes = {}
+        for m in updated:
+            outfilename = window_name(datetime.datetime.strptime(m['ts'], DATE_FORMAT), month_block)
+            changes.setdefault(outfilename, ({}, set()))[0][m['_id']] = m
+        for message_id in deleted:
+            summary = message_index.get(message_id) if message_index is not None else None
+            if summary is None:
+                logger.debug('Deleted message %s is not in the message index', message_id)
+                continue
+            outfilename = window_name(datetime.datetime.strptime(summary['ts'], DATE_FORMAT), month_block)
+            changes.setdefault(outfilename, ({}, set()))[1].add(message_id)
+
+        patched = 0
+        for outfilename, (window_updated, window_deleted) in sorted(changes.items()):
+            if not self.window_exists(outfilename, room_name):
+                continue
+
+            messages = self.read_window(outfilename, room_name)
+            messages = [window_updated.pop(m.get('_id'), m) for m in messages
+                        if m.get('_id') not in window_deleted]
+            messages += window_updated.values()
+            messages.sort(key=lambda m: m['ts'], reverse=True)
+
+            outfile = self.open_window(outfilename, room_name)
+            for m in messages:
+                outfile.write(m)
+            outfile.close()
+            patched += 1
+
+        if updated:
+            futures = self.download_attachments(updated, logger)
+            self.download_avatars(updated, logger)
+            if message_index is not None:
+                message_index.add(updated, room_name)
+            # lastsync only moves on once the attachments are on disk
+            concurrent.futures.wait(futures)
+            self.check_stop()
+        if deleted and message_index is not None:
+            message_index.remove(deleted)
+
+        channel_data['lastsync'] = sync_time
+        self.state.set_lastsync(channel_id, sync_time)
+        logger.info('Synced %d updated and %d deleted messages, %d history files patched',
+                    len(updated), len(deleted), patched)
+
+    def window_exists(self, outfilename, room_name):
+        """Whether a window is completely on disk. A history file that is
+        cut short (e.g. written by an older version that was interrupted)
+        does not count, so skip_when_file_exists exports it again."""
+        archive = self.settings['archive']
+        if archive is not None:
+            return archive.has_window(outfilename, room_name)
+        path = history_file_path(self.settings['output_dir'], outfilename, room_name)
+        if not os.path.isfile(path):
+            return False
+        if not history_file_complete(path):
+            self.logger.warning('History file %s is incomplete, it is exported again', path)
+            return False
+        return True
+
+    def read_window(self, outfilename, room_name):
+        """Messages of a window that is on disk, in the configured format"""
+        archive = self.settings['archive']
+        if archive is not None:
+            return archive.read_window(outfilename, room_name)
+        return load_history_file(history_file_path(self.settings['output_dir'],
+                                                   outfilename, room_name))
+
+    def open_window(self, outfilename, room_name):
+        """Writer for the messages of a window, in the configured format"""
+        archive = self.settings['archive']
+        if archive is not None:
+            return archive.open_window(outfilename, room_name)
+        return JsonHistoryWriter(history_file_path(self.settings['output_dir'],
+                                                   outfilename, room_name))
+
+    def history_page(self, channel_id, channel_data, t_oldest, t_latest, offset, logger):
+        """Fetch one page of messages between t_oldest and t_latest, newest first"""
+        if channel_data['type'] == 'channels':
+            fetch_history = self.rocket.channels_history
+        elif channel_data['type'] == 'ims':
+            fetch_history = self.rocket.im_history
+        elif channel_data['type'] == 'groups':
+            fetch_history = self.rocket.groups_history
+
+        logger.debug('invoking API to get messages (offset %d)', offset)
+        history_data_obj = self.rate.request(
+            lambda: fetch_history(
+                channel_id,
+                count=self.settings['page_size'],
+                offset=offset,
+                include='true',
+                latest=get_rocketchat_timestamp(t_latest),
+                oldest=get_rocketchat_timestamp(t_oldest)),
+            'history of ' + channel_data['name'])
+
+        history_data = history_data_obj.json()
+
+        if not history_data['success']:
+            error_text = history_data['error']
+            logger.error('Error response from API endpoint: %s', error_text)
+            raise Exception('Untrapped error response from history API: '
+                            + '{error_text}'
+                            .format(error_text=error_text))
+
+        return history_data['messages']
+
+    def history_pages(self, channel_id, channel_data, t_oldest, t_latest, logger):
+        """Yield the messages between t_oldest and t_latest page by page,
+        newest first, walking the window with offset"""
+        count_max = self.settings['count_max']
+
+        offset = 0
+        while True:
+            self.check_stop()
+            messages = self.history_page(channel_id, channel_data, t_oldest, t_latest, offset, logger)
+            if messages:
+                yield messages
+            offset += len(messages)
+
+            if self.last_page(messages, lambda: self.history_page(
+                    channel_id, channel_data, t_oldest, t_latest, offset, logger), logger):
+                return
+            if offset >= count_max:
+                logger.error('More than %d messages between %s and %s, the history '
+                             'file for this window is INCOMPLETE. Raise '
+                             'max_msg_count_per_day to export all of them.',
+                             count_max,
+                             get_rocketchat_timestamp(t_oldest),
+                             get_rocketchat_timestamp(t_latest))
+                return
+
+    def last_page(self, messages, fetch_next, logger):
+        """Whether messages, a page of a window or span, is the last one.
+
+        A page shorter than page_size is, unless the server returns fewer
+        messages per request than asked for (page_size above its
+        API_Upper_Count_Limit), which would cut windows short. Such a cap
+        is the length of the longest page seen, so the first time a page
+        of a new longest length comes back short, fetch_next() fetches the
+        page after it once. If that holds messages, page_size is lowered
+        to the cap for the rest of the run. Other rooms wait for the probe,
+        so they do not take a page of the same length as their last one."""
+        length = len(messages)
+        with self._page_lock:
+            if length >= self.settings['page_size']:
+                return False
+            if length == 0 or length < self.longest_page or length in self.probed_pages:
+                return True
+            self.longest_page = length
+            self.probed_pages.add(length)
+            if not fetch_next():
+                return True
+            logger.warning('The server returns at most %d messages per request, lowering '
+                           'page_size from %d to %d (see API_Upper_Count_Limit)',
+                           length, self.settings['page_size'], length)
+            self.settings['page_size'] = length
+            return False
+
+    def download_attachments(self, messages, logger):
+        """Queue the files attached to messages that are not on disk yet
+        for download. Returns the futures of the downloads."""
+        output_dir = self.settings['output_dir']
+        file_prefix = self.settings['file_prefix']
+        file_folder = self.settings['file_folder']
+        rc_server = self.settings['rc_server']
+        manifest = self.downloader.manifest
+        futures = []
+
+        for m in messages:
+            for a in m.get('attachments', []):
+                if 'title_link' in a:
+                    urlname = a.get('title_link')
+
+                    if manifest is not None:
+                        if urlname not in manifest:
+                            futures.append(self.downloader.submit(
+                                rc_server + urlname, manifest.staging_path(urlname),
+                                key=urlname))
+                        continue
+
+                    diskname = attachment_diskname(urlname, file_prefix)
+                    diskpath = output_dir + file_folder +'/'+ diskname
+
+                    if not os.path.isfile( diskpath ):
+                        futures.append(self.downloader.submit(rc_server + urlname, diskpath))
+                    else:
+                        logger.debug('Attachment exists: '+diskname)
+        return futures
+
+    def download_avatars(self, messages, logger):
+        """Make sure the avatars of all message authors are on disk"""
+        for m in messages:
+            self.avatars.update(m.get('u',{}).get('username','none'), logger)
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def plan_export(exporter, rooms, rate, logger):
+    """Log the windows and history requests an export of rooms would take,
+    busiest room first, and how long the requests take at the configured
+    rate. Nothing is fetched or written."""
+    quiet = logging.getLogger('export-history.plan')
+    quiet.addHandler(logging.NullHandler())
+    quiet.propagate = False
+
+    plans = []
+    for channel_id, channel_data in rooms:
+        _, windows = exporter.plan_windows(channel_data, quiet)
+        fewest, most = exporter.plan_requests(windows)
+        plans.append((most, fewest, windows, channel_data))
+    plans.sort(key=lambda plan: (-plan[0], plan[3]['name']))
+
+    total_windows = total_fewest = total_most = 0
+    logger.info('%-40s %-12s %-12s %8s %17s %21s', 'room', 'from', 'to', 'windows',
+                'requests', 'time')
+    for most, fewest, windows, channel_data in plans:
+        seconds_fewest = rate.estimate_seconds(fewest, total_fewest)
+        seconds_most = rate.estimate_seconds(most, total_most)
+        logger.info('%-40s %-12s %-12s %8d %8d - %-6d %10s - %-8s',
+                    channel_data['name'][:40],
+                    windows[0][0] if windows else '-', windows[-1][0] if windows else '-',
+                    len(windows), fewest, most,
+                    format_duration(seconds_fewest), format_duration(seconds_most))
+        total_windows += len(windows)
+        total_fewest += fewest
+        total_most += most
+
+    logger.info('Plan: %d rooms, %d windows, %d to %d history requests '
+                '(more for windows with more than %d messages)',
+                len(plans), total_windows, total_fewest, total_most, exporter.settings['page_size'])
+    logger.info('Estimated time: %s to %s, at %.2f requests/s rising to %.2f '
+                '(shared by all workers; not counting response times, attachments, '
+                'avatars and rate limiting)',
+                format_duration(rate.estimate_seconds(total_fewest)),
+                format_duration(rate.estimate_seconds(total_most)),
+                rate.rate, rate.max_rate)
+
+
 #
 # Main
 #
@@ -158,11 +1460,27 @@ def main():
     argparser_main.add_argument('-r', '--readonlystate',
                                 help='Do not create or update history state file.',
                                 action="store_true")
+    argparser_main.add_argument('-d', '--deltasync',
+                                help='Also patch messages edited or deleted since the last run ' + \
+                                'into the existing history files',
+                                action="store_true")
     argparser_main.add_argument('-l', '--list',
                                 help='Print a room list (for use in "include" and "exclude") and exit',
                                 action="store_true")
+    argparser_main.add_argument('-p', '--plan',
+                                help='Print the windows and number of requests an export would take, ' + \
+                                'with an estimate of its duration, and exit',
+                                action="store_true")
+    argparser_main.add_argument('--shard', type=parse_shard,
+                                help='Only export the rooms of shard i of N (e.g. 2/4), with a state ' + \
+                                'and message index of its own, so N exports can run side by side')
+    argparser_main.add_argument('--merge-shards', type=int, metavar='N',
+                                help='Merge the state and message index of shards 1/N to N/N into ' + \
+                                'the main ones and exit')
 
     args = argparser_main.parse_args()
+    if args.merge_shards is not None and (args.shard or args.readonlystate or args.merge_shards < 1):
+        argparser_main.error('--merge-shards N needs N >= 1 and goes without --shard and -r')
 
     start_time = (datetime
                   .datetime
@@ -186,15 +1504,31 @@ def main():
                                                 second=59,
                                                 microsecond=999999))
 
+    # changes are synced up to the start of the run (in UTC, like message
+    # timestamps), so the next delta sync picks up everything after it
+    sync_time = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
 
     # config
     config_main = configparser.ConfigParser()
     config_main.read(args.configfile)
 
     polite_pause = int(config_main['rc-api']['pause_seconds'])
+    concurrency = config_main.getint('rc-api', 'concurrency', fallback=1)
+    download_concurrency = config_main.getint('rc-api', 'download_concurrency', fallback=4)
+    # the rate only grows beyond one request per pause_seconds if asked to
+    max_rate = config_main.getfloat('rc-api', 'max_requests_per_second',
+                                    fallback=1.0 / polite_pause if polite_pause > 0 else 20)
+    max_retries = config_main.getint('rc-api', 'max_retries', fallback=5)
+    max_wait = config_main.getint('rc-api', 'max_rate_limit_wait', fallback=900)
     count_max = int(config_main['rc-api']['max_msg_count_per_day'])
+    adaptive_windows = config_main.getboolean('rc-api', 'adaptive_windows', fallback=True)
+    room_list_ttl = config_main.getfloat('rc-api', 'room_list_ttl_minutes', fallback=10)
+    page_size = min(count_max, config_main.getint('rc-api', 'page_size', fallback=100))
     output_dir = config_main['files']['history_output_dir']
     state_file = config_main['files']['history_statefile']
+    state_db = config_main.get('files', 'history_statedb',
+                               fallback=os.path.splitext(state_file)[0] + '.sqlite')
 
     skip_if_file_exists = config_main.get('files', 'skip_when_file_exists', fallback = False)
 
@@ -208,6 +1542,29 @@ def main():
 
     file_prefix = config_main.get('files','file_prefix', fallback='');
     file_folder = config_main.get('files','file_folder', fallback='attachments');
+    avatar_folder = config_main.get('files', 'avatar_folder', fallback='avatar')
+    avatar_ttl_hours = config_main.getfloat('files', 'avatar_ttl_hours', fallback=168)
+    avatar_failure_ttl_hours = config_main.getfloat('files', 'avatar_failure_ttl_hours', fallback=24)
+    content_addressed = config_main.getboolean('files', 'content_addressed', fallback=False)
+    history_format = config_main.get('files', 'history_format', fallback='json').strip()
+    metrics_file = config_main.get('files', 'metrics_file', fallback='export-metrics.json')
+    metrics_prometheus_file = config_main.get('files', 'metrics_prometheus_file', fallback='')
+    message_index_db = config_main.get('files', 'message_index',
+                                       fallback=output_dir + 'message-index.sqlite')
+
+    # a shard keeps its own state, message index and metrics next to the
+    # main ones
+    shard = args.shard
+    main_state_db = state_db
+    main_message_index_db = message_index_db
+    if shard is not None:
+        state_db = shard_path(state_db, shard)
+        if message_index_db:
+            message_index_db = shard_path(message_index_db, shard)
+        if metrics_file:
+            metrics_file = shard_path(metrics_file, shard)
+        if metrics_prometheus_file:
+            metrics_prometheus_file = shard_path(metrics_prometheus_file, shard)
 
     
     # include and exclude rooms
@@ -245,34 +1602,90 @@ def main():
 
     if args.readonlystate:
         logger.info('Running in readonly state mode. No state file updates.')
-
-    if os.path.isfile(state_file):
+    if shard is not None:
+        logger.info('Exporting shard %d of %d', shard[0] + 1, shard[1])
+
+    # a second run with the same state (an overlapping cron job, or the
+    # same shard started twice) would export the same rooms again. An
+    # unsharded run (or a merge) holds the lock of the main state
+    # exclusively; shards share it and hold the lock of their own state
+    # exclusively, so they only exclude each other per shard. Listing and
+    # planning export nothing and take no lock.
+    if not (args.list or args.plan):
+        main_state_lock = open(main_state_db + '.lock', 'a+')
+        if not try_lock(main_state_lock, shared=shard is not None):
+            logger.error('Another export is running with state %s, exiting', main_state_db)
+            return
+        if shard is not None:
+            state_lock = open(state_db + '.lock', 'a+')
+            if not try_lock(state_lock):
+                logger.error('Another export is running with state %s, exiting', state_db)
+                return
+
+    # a plan writes nothing, not even the pickle import or the room list
+    # cache, as it runs without the lock
+    state = StateStore(state_db, readonly=args.readonlystate or args.plan)
+
+    if not state.is_empty():
+        logger.debug('LOAD state from %s', state_db)
+        room_state = state.load()
+        logger.debug('%d rooms in state', len(room_state) - 1)
+
+    elif os.path.isfile(state_file):
         logger.debug('LOAD state from %s', state_file)
-        sf = open(state_file, 'rb')
-        room_state = pickle.load(sf)
-        sf.close()
-        logger.debug('\n%s', pprint.pformat(room_state))
-        schema_version = 1.0 if '_meta' not in room_state else room_state['_meta']['schema_version']
-        if schema_version < VERSION:
-            upgrade_state_schema(room_state, schema_version, logger)
+        room_state = state.import_pickle(state_file, logger)
+        logger.debug('%d rooms in state', len(room_state) - 1)
 
     else:
-        logger.debug('No state file at %s, so state will be created', state_file)
+        logger.debug('No state file at %s, so state will be created', state_db)
         room_state = {'_meta': {'schema_version': VERSION}}
 
+    if args.merge_shards:
+        for i in range(args.merge_shards):
+            shard_state_db = shard_path(state_db, (i, args.merge_shards))
+            if not os.path.isfile(shard_state_db):
+                logger.warning('No state for shard %d at %s', i + 1, shard_state_db)
+                continue
+            logger.info('MERGE state of shard %d from %s', i + 1, shard_state_db)
+            state.merge(room_state, StateStore(shard_state_db, readonly=True).load(),
+                        keep=lambda room_id: room_shard(room_id, args.merge_shards) == i)
+
+            shard_message_index_db = shard_path(message_index_db, (i, args.merge_shards)) \
+                if message_index_db else ''
+            if shard_message_index_db and os.path.isfile(shard_message_index_db):
+                logger.info('MERGE message index of shard %d from %s', i + 1, shard_message_index_db)
+                MessageIdIndex(message_index_db).merge(shard_message_index_db)
+        logger.info('%d rooms in state', len(room_state) - 1)
+        return
+
+    if shard is not None and os.path.isfile(main_state_db):
+        # take over what unsharded runs (or a merge) recorded for the rooms
+        # of this shard
+        logger.debug('MERGE state of the rooms of this shard from %s', main_state_db)
+        state.merge(room_state, StateStore(main_state_db, readonly=True).load(),
+                    keep=lambda room_id: room_shard(room_id, shard[1]) == shard[0])
+
     if rooms_exclude:
         logger.debug("Excluded rooms: " + ", ".join(rooms_exclude))
     if rooms_include:
         logger.debug("Included rooms: " + ", ".join(rooms_include))
 
+    session = make_session(config_main, pool_size=concurrency + download_concurrency)
+
     if ( rc_auth == "token"):
         logger.debug('Initialize rocket.chat API connection (token)')
-        rocket = RocketChat(auth_token=rc_pass, user_id=rc_user, server_url=rc_server)
+        rocket = RocketChat(auth_token=rc_pass, user_id=rc_user, server_url=rc_server,
+                            session=session, timeout=session.timeout)
     else:
         logger.debug('Initialize rocket.chat API connection (user/password)')
-        rocket = RocketChat(rc_user, rc_pass, server_url=rc_server)
+        rocket = RocketChat(rc_user, rc_pass, server_url=rc_server,
+                            session=session, timeout=session.timeout)
+
+    metrics = RunMetrics({'shard': '%d/%d' % (shard[0] + 1, shard[1])} if shard is not None else None)
+    rate = RateController(1.0 / polite_pause if polite_pause > 0 else max_rate,
+                          max_rate, logger, max_retries=max_retries, max_wait=max_wait,
+                          metrics=metrics)
 
-    sleep(polite_pause)
     if skip_if_file_exists :
         logger.debug("Skip set to TRUE: will not retrieve history for days where a file already exists")
 
@@ -280,11 +1693,20 @@ def main():
         logger.debug("Month block set to TRUE")
 
     logger.debug('LOAD / UPDATE room state')
-    assemble_state(room_state, rocket.channels_list_joined().json(), 'channels')
+    room_lists = None
+    if room_list_ttl > 0:
+        room_lists = state.load_room_lists(datetime.timedelta(minutes=room_list_ttl))
+    if room_lists is None:
+        room_lists = fetch_room_lists(rocket, rate, page_size, concurrency)
+        state.save_room_lists(room_lists)
+    else:
+        logger.debug('Using the room list fetched less than %s minutes ago', room_list_ttl)
+
+    assemble_state(room_state, room_lists, 'channels')
 
-    assemble_state(room_state, rocket.im_list().json(), 'ims', ims_name = config_main.get('rooms','ims_ownname', fallback = None))
+    assemble_state(room_state, room_lists, 'ims', ims_name = config_main.get('rooms','ims_ownname', fallback = None))
 
-    assemble_state(room_state, rocket.groups_list().json(), 'groups')
+    assemble_state(room_state, room_lists, 'groups')
 
     if args.list:
         for channel_id, channel_data in room_state.items():
@@ -292,14 +1714,35 @@ def main():
                 logger.info( "subscribed: \""+channel_data['name'] + "\" (type " +channel_data['type'] + ")")
         return    
 
-    sleep(polite_pause)
-
-    userkeys = []
-
+    archive = None
+    if history_format.startswith('jsonl.'):
+        logger.debug('Writing history as %s archives', history_format)
+        archive = HistoryArchive(output_dir, history_format[len('jsonl.'):])
+    elif history_format != 'json':
+        raise ValueError('Unknown history_format: ' + history_format)
+
+    settings = {
+        'start_time': start_time,
+        'end_time': end_time,
+        'month_block': month_block,
+        'output_dir': output_dir,
+        'archive': archive,
+        'message_index': None,
+        'delta_sync': args.deltasync,
+        'sync_time': sync_time,
+        'count_max': count_max,
+        'page_size': page_size,
+        'adaptive_windows': adaptive_windows,
+        'skip_if_file_exists': skip_if_file_exists,
+        'file_prefix': file_prefix,
+        'file_folder': file_folder,
+        'rc_server': rc_server,
+    }
+
+    rooms = []
     for channel_id, channel_data in room_state.items():
 
         if channel_id != '_meta':  # skip state metadata which is not a channel
-            logger.info('------------------------')
 
             if channel_data['name'] in rooms_exclude:
                 logger.info('Skipping room (in exclude list): '+channel_data['name'])
@@ -309,235 +1752,124 @@ def main():
                 logger.info('Skipping room (not in include list): '+channel_data['name'])
                 continue
 
-            logger.info('Processing room: ' + channel_id + ' - ' + channel_data['name'])
-
-            logger.debug('Global start time: %s', str(start_time))
-            logger.debug('Global end time: %s', str(end_time))
-            logger.debug('Room start ts: %s', str(channel_data['begintime']))
-            logger.debug('Last message: %s', str(channel_data['lastmessage']))
-            logger.debug('Last saved: %s ', str(channel_data['lastsaved']))
-
-            if start_time is not None:
-                # use globally specified start time but if the start time
-                # is before the channel existed, fast-forward to its creation
-                t_oldest = channel_data['begintime'] if channel_data['begintime'] > start_time \
-                else start_time
-            elif channel_data['lastsaved'] != NULL_DATE:
-                # no global override for start time, so use a tick after
-                # the last saved date if it exists
-                t_oldest = channel_data['lastsaved'] + datetime.timedelta(microseconds=1)
-            else:
-                # nothing specified at all so use the beginning time of the channel
-                t_oldest = channel_data['begintime']
-
-            t_latest = NULL_DATE
+            if shard is not None and room_shard(channel_id, shard[1]) != shard[0]:
+                continue
 
-            if month_block:
-                t_oldest = t_oldest.replace(day=1)
-                logger.info('Month mode: grabbing messages in blocks of months')
+            if (start_time is None and not args.deltasync
+                    and channel_data['lastmessage'] <= channel_data['lastsaved']):
+                logger.debug('Skipping room (no messages since last run): '+channel_data['name'])
+                # checked through end_time all the same, see 'lastsaved' below
+                if end_time > channel_data['lastsaved']:
+                    channel_data['lastsaved'] = end_time
+                    state.save_room(channel_id, channel_data)
+                continue
 
-            if (t_oldest < end_time) and (t_oldest < channel_data['lastmessage']):
-                logger.info('Grabbing messages since '
-                            + str(t_oldest)
-                            + ' through '
-                            + str(end_time))
-            else:
-                logger.info('Nothing to grab between '
-                            + str(t_oldest)
-                            + ' through '
-                            + str(end_time))
+            rooms.append((channel_id, channel_data))
+
+    if args.plan:
+        plan_export(RoomExporter(rocket, rate, None, None, state, logger, settings),
+                    rooms, rate, logger)
+        return
+
+    message_index = None
+    if message_index_db:
+        # messages exported before sharding are only in the main index
+        fallback = None
+        if shard is not None and main_message_index_db and os.path.isfile(main_message_index_db):
+            fallback = MessageIdIndex(main_message_index_db, readonly=True)
+        message_index = MessageIdIndex(message_index_db, fallback=fallback)
+    settings['message_index'] = message_index
+
+    manifest = None
+    if content_addressed:
+        logger.debug('Storing attachments content-addressed')
+        manifest = AttachmentManifest(output_dir + file_folder)
+        os.makedirs(os.path.join(manifest.folder, 'incoming'), exist_ok=True)
+
+    # rocket.headers holds the auth token for either kind of login. Bodies
+    # are fetched unencoded, as Range offsets refer to the stored file.
+    downloader = AttachmentDownloader(
+        lambda url, headers: session.get(url, stream=True, headers={
+            **rocket.headers, 'Accept-Encoding': 'identity', **headers}),
+        logger, workers=download_concurrency, rate=rate, manifest=manifest)
+
+    avatars = AvatarCache(output_dir + avatar_folder, rc_server, session, rate,
+                          ttl=avatar_ttl_hours * 3600,
+                          failure_ttl=avatar_failure_ttl_hours * 3600)
+
+    # store the room list now, so checkpoints have a row to go to
+    state.save(room_state)
+
+    exporter = RoomExporter(rocket, rate, downloader, avatars, state, logger, settings)
+
+    logger.info('Exporting with %d concurrent worker(s)', concurrency)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency))
+    jobs = {}
+    for channel_id, channel_data in rooms:
+        jobs[pool.submit(exporter.export_room, channel_id, channel_data)] = channel_id
+
+    failed_rooms = []
+    try:
+        for job in concurrent.futures.as_completed(jobs):
+            channel_id = jobs[job]
+            try:
+                job.result()
+            except Exception:
+                logger.exception('Export of room %s failed, its state is not updated',
+                                 room_state[channel_id]['name'])
+                failed_rooms.append(room_state[channel_id]['name'])
+                continue
 
-            while (t_oldest < end_time) and (t_oldest < channel_data['lastmessage']):
-                logger.info('')
-
-                if month_block:
-                    outfilename = t_oldest.strftime('%Y-%m')+'-NN'
-                else:
-                    outfilename = t_oldest.strftime('%Y-%m-%d')
-
-                if skip_if_file_exists :
-                    while ( os.path.isfile( output_dir
-                        + outfilename
-                        + '-'
-                        + channel_data['name']
-                        + '.json' )):
-
-                        t_oldest = incr_by_day_or_month( t_oldest, month_block)
-
-                        if month_block:
-                            outfilename = t_oldest.strftime('%Y-%m')+'-NN'
-                        else:
-                            outfilename = t_oldest.strftime('%Y-%m-%d')
-
-                        logger.info('skipping %s (as history file already exists) '+outfilename, get_rocketchat_timestamp(t_oldest))
-
-                t_latest = incr_by_day_or_month( t_oldest, month_block) - datetime.timedelta(microseconds=1)
-
-                logger.info('start: %s', get_rocketchat_timestamp(t_oldest))
-
-                history_data_obj = {}
-                retry_flag = True
-                retry_count = 0
-
-                while retry_flag:
-                    retry_count += 1
-                    logger.debug('invoking API to get messages (attempt %d)', retry_count)
-                    if channel_data['type'] == 'channels':
-                        history_data_obj = rocket.channels_history(
-                            channel_id,
-                            count=count_max,
-                            include='true',
-                            latest=get_rocketchat_timestamp(t_latest),
-                            oldest=get_rocketchat_timestamp(t_oldest))
-                    elif channel_data['type'] == 'ims':
-                        history_data_obj = rocket.im_history(
-                            channel_id,
-                            count=count_max,
-                            include='true',
-                            latest=get_rocketchat_timestamp(t_latest),
-                            oldest=get_rocketchat_timestamp(t_oldest))
-                    elif channel_data['type'] == 'groups':
-                        history_data_obj = rocket.groups_history(
-                            channel_id,
-                            count=count_max,
-                            include='true',
-                            latest=get_rocketchat_timestamp(t_latest),
-                            oldest=get_rocketchat_timestamp(t_oldest))
-
-                    history_data = history_data_obj.json()
-                    history_data_text = history_data_obj.text
-
-                    if not history_data['success']:
-                        error_text = history_data['error']
-                        logger.error('Error response from API endpoint: %s', error_text)
-                        if 'error-too-many-requests' in error_text:
-                            seconds_search = re.search(r'must wait (\d+) seconds',
-                                                       error_text,
-                                                       re.IGNORECASE)
-                            if seconds_search:
-                                seconds_to_wait = int(seconds_search.group(1))
-                                if seconds_to_wait < 300:
-                                    polite_pause += seconds_to_wait \
-                                    if seconds_to_wait < polite_pause \
-                                    else polite_pause
-                                    logger.error('Attempting handle API rate limit error by \
-                                                 sleeping for %d and updating polite_pause \
-                                                 to %d for the duration of this execution',
-                                                 seconds_to_wait, polite_pause)
-                                    sleep(seconds_to_wait)
-                                else:
-                                    raise Exception('Unresonable amount of time to wait '
-                                                    + 'for API rate limit')
-                            else:
-                                raise Exception('Can not parse too-many-requests error message')
-                        else:
-                            raise Exception('Untrapped error response from history API: '
-                                            + '{error_text}'
-                                            .format(error_text=error_text))
-                    else:
-                        retry_flag = False
-
-
-                num_messages = len(history_data['messages'])
-                logger.info('Messages found: %s', str(num_messages))
-
-                # attachments download
-                for m in history_data['messages']:
-                    for a in m.get('attachments', []):
-                        if 'title_link' in a:
-                            urlname = a.get('title_link')
-
-                            if urlname.startswith(file_prefix):
-                                diskname = urlname[len(file_prefix):]
-
-                            diskname = urllib.parse.unquote(diskname)
-                            diskname = re.sub('\s+|\:','_',diskname)                             
-
-                            diskname = diskname.replace('/','-')
-                            diskpath = output_dir + file_folder +'/'+ diskname
-
-                            if not os.path.isfile( diskpath ):
-                                # TODO: this only works with access tokens. Would need a switching
-                                # statement for the username/password option
-                                req = requests.get(rc_server + urlname,
-                                    headers={ 'X-Auth-Token': rc_pass , 'X-User-Id': rc_user })
-
-                                if req.status_code == 200 :
-                                    fout = open( diskpath, 'wb')
-                                    fout.write( req.content )
-                                    logger.debug('Downloaded attachment: ' +urlname+' --> '+diskname)
-                                else:
-                                    logger.warn('Failed to download: '+urlname)
-                                    
-                                sleep(polite_pause)
-
-                            else:
-                                    logger.debug('Attachment exists: '+diskname)
-
-                # avatar download
-                for m in history_data['messages']:
-                        a =  m.get('u',[]).get('username','none')
-                        
-                        if a in userkeys:
-                                continue
-
-                        diskpath =  output_dir + '/avatar/' + a + '.jpg'
-
-                        if not os.path.isfile(diskpath):
-                                req = requests.get( rc_server + '/avatar/' + a + '?format=jpeg' )
-                                if req.status_code == 200 :
-                                    fout = open( diskpath, 'wb')
-                                    fout.write( req.content )
-                                    logger.debug('Downloaded avatar: ' + a)
-                                    userkeys.append(a)
-                                else:
-                                    logger.warn('Failed to download avatar: '+ a)
-                                sleep(polite_pause)
-                        else:
-                                logger.debug('Avatar on disk:' + a)
-                                userkeys.append(a)
-
-                                 
-
-
-
-                if num_messages > 0:
-                    with open(output_dir
-                              + outfilename
-                              + '-'
-                              + re.sub('\s+','_',channel_data['name'])
-                              + '.json', 'wb') as f:
-                        f.write(history_data_text.encode('utf-8').strip())
-                elif num_messages > count_max:
-                    logger.error('Too many messages for this room today. SKIPPING.')
-
-                logger.info('end: %s', get_rocketchat_timestamp(t_latest))
-                logger.info('')
-                t_oldest = incr_by_day_or_month( t_oldest, month_block)
-                sleep(polite_pause)
-
-            logger.info('------------------------\n')
-
-        # I am changing what 'lastsaved' means here. It used to denote the
-        # last time a file was actually saved to disk for this channel
-        # but I think it is more useful if it represents the maximum time for
-        # which the channel has been checked. this will reduce lots
-        # of unnecessary day checks if a channel is dormant for a while and then
-        # suddenly has a message in it. This is only helpful if the
-        # history export script is run on a periodic basis.
-        room_state[channel_id]['lastsaved'] = end_time
+            logger.info('Finished room: %s', room_state[channel_id]['name'])
+
+            # I am changing what 'lastsaved' means here. It used to denote the
+            # last time a file was actually saved to disk for this channel
+            # but I think it is more useful if it represents the maximum time for
+            # which the channel has been checked. this will reduce lots
+            # of unnecessary day checks if a channel is dormant for a while and then
+            # suddenly has a message in it. This is only helpful if the
+            # history export script is run on a periodic basis.
+            room_state[channel_id]['lastsaved'] = end_time
+            room_state[channel_id].pop('checkpoint', None)
+            state.save_room(channel_id, room_state[channel_id])
+    except KeyboardInterrupt:
+        # the workers are not daemon threads, so the interpreter only exits
+        # once they have noticed the stop and given up on their rooms; the
+        # checkpoints they recorded so far are kept for the next run
+        logger.warning('Interrupted, stopping the export after the requests in flight')
+        exporter.stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        downloader.cancel()
+        raise
+
+    pool.shutdown()
+
+    avatars.save()
+
+    logger.info('Waiting for attachment downloads to finish')
+    downloader.join()
+    if downloader.failed:
+        logger.warning('%d attachment(s) could not be downloaded', len(downloader.failed))
+    metrics.count('downloaded_bytes_total', {'kind': 'attachment'}, downloader.bytes_downloaded)
+    metrics.count('attachments_failed_total', value=len(downloader.failed))
 
     if not args.readonlystate:
-        logger.debug('UPDATE state file')
-        logger.debug('\n%s', pprint.pformat(room_state))
-        sf = open(state_file, 'wb')
-        pickle.dump(room_state, sf)
-        sf.close()
+        logger.debug('UPDATE state file (%d rooms)', len(room_state) - 1)
+        state.save(room_state)
     else:
         logger.debug('Running in readonly state mode: SKIP updating state file')
 
+    if metrics_file:
+        metrics.write_json(metrics_file, failed_rooms)
+        logger.info('Run metrics written to %s', metrics_file)
+    if metrics_prometheus_file:
+        metrics.write_prometheus(metrics_prometheus_file, failed_rooms)
+
     logger.info('END execution at %s\n------------------------\n\n',
                 str(datetime.datetime.today()))
 
+    if failed_rooms:
+        raise Exception('Export failed for room(s): ' + ', '.join(failed_rooms))
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,672 @@
+"""
+Description:
+    Helpers shared by export-history.py, html-convert.py and
+    search-history.py
+
+Dependencies:
+    pipenv install
+        requests - HTTP library
+            (pipenv install requests)
+        zstandard - only for history_format = jsonl.zst
+            (pipenv install zstandard)
+
+"""
+import os
+import re
+import gzip
+import json
+import zlib
+import sqlite3
+import hashlib
+import mimetypes
+import threading
+import urllib.parse
+import concurrent.futures
+import requests
+import requests.adapters
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# history files: '<YYYY-MM>-<DD or NN>-<room>.json', one per window ('NN'
+# marking a month with month_blocks), or '<YYYY-MM>-<room>.jsonl.gz'
+# ('.zst'), one per month, see HistoryArchive
+HISTORY_FILE_RE = re.compile(r'^(\d{4}-\d{2})-(\d{2}|NN)-(.+)\.json$')
+ARCHIVE_FILE_RE = re.compile(r'^(\d{4}-\d{2})-(.+)\.jsonl\.(gz|zst)$')
+
+
+class HttpSession(requests.Session):
+    """requests.Session that applies a default timeout to every request"""
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def make_session(config, pool_size=10):
+    """Create the one HTTP session used for all traffic to the server:
+    API calls, attachments and avatars. Connections are pooled and kept
+    alive, so TLS handshakes are paid once per connection instead of once
+    per request. Settings are read from the [rc-api] section.
+
+    The pool keeps up to pool_size connections alive. It does not block
+    when they are all in use: a request then opens an extra connection
+    that is closed afterwards. Blocking would cap the connections, but a
+    response that is not closed somewhere would hang every later request
+    for good."""
+    pool_size = config.getint('rc-api', 'pool_size', fallback=pool_size)
+    timeout = (config.getfloat('rc-api', 'connect_timeout', fallback=10),
+               config.getfloat('rc-api', 'read_timeout', fallback=60))
+
+    session = HttpSession(timeout)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                            pool_maxsize=pool_size,
+                                            pool_block=False)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if not config.getboolean('rc-api', 'keep_alive', fallback=True):
+        session.headers['Connection'] = 'close'
+    if not config.getboolean('rc-api', 'compression', fallback=True):
+        session.headers['Accept-Encoding'] = 'identity'
+
+    return session
+
+
+def login_headers(config, session):
+    """Return the X-Auth-Token / X-User-Id headers for downloads, logging
+    in with username and password unless token auth is configured"""
+    rc_user = config['rc-api']['user']
+    rc_pass = config['rc-api']['pass']
+
+    if config.get('rc-api', 'auth', fallback='classic').strip() == 'token':
+        return {'X-Auth-Token': rc_pass, 'X-User-Id': rc_user}
+
+    response = session.post(config['rc-api']['server'] + '/api/v1/login',
+                            json={'user': rc_user, 'password': rc_pass})
+    response.raise_for_status()
+    data = response.json()['data']
+    return {'X-Auth-Token': data['authToken'], 'X-User-Id': data['userId']}
+
+
+def try_lock(fileobj, shared=False):
+    """Take an exclusive (or shared) lock on an open file without waiting.
+    Returns False if another process holds a conflicting lock. The lock is
+    released when the file is closed; a shared lock needs the file to be
+    open for reading. POSIX record locks are used, which also work on NFS;
+    where fcntl is not available nothing is locked."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.lockf(fileobj, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def attachment_diskname(urlname, file_prefix):
+    """File name of an attachment in the plain (not content-addressed) layout"""
+    diskname = urlname
+
+    if urlname.startswith(file_prefix):
+        diskname = urlname[len(file_prefix):]
+
+    diskname = urllib.parse.unquote(diskname)
+    diskname = re.sub(r'\s+|\:', '_', diskname)
+
+    return diskname.replace('/', '-')
+
+
+class AttachmentManifest:
+    """Content-addressed attachment store.
+
+    Files are kept under the attachment folder as 'ab/abcdef...ext', named
+    by the SHA-256 of their content, so a file posted to many rooms is
+    stored once. 'manifest.jsonl' in the same folder maps every attachment
+    URL to the hash, size and mime type of its content. It is loaded into
+    memory once, so checking whether a URL is already downloaded needs no
+    disk access, and it is only ever appended to.
+    """
+    FILENAME = 'manifest.jsonl'
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, self.FILENAME)
+        self.entries = {}
+        self.hashes = set()
+        self._lock = threading.Lock()
+
+        if os.path.isfile(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        self.entries[entry['url']] = entry
+                        self.hashes.add(entry['sha256'])
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def relpath(self, entry):
+        """Path of a stored file, relative to the attachment folder"""
+        return entry['sha256'][:2] + '/' + entry['sha256'] + entry.get('ext', '')
+
+    def staging_path(self, url):
+        """Where the download of url is kept until its hash is known"""
+        return os.path.join(self.folder, 'incoming',
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def store(self, url, tmppath, sha256, size, mime):
+        """Move the downloaded file tmppath into the store and record url.
+        Returns False if the same content was stored before."""
+        ext = os.path.splitext(urllib.parse.unquote(url))[1].lower()
+        if not re.match(r'^\.[a-z0-9]{1,10}$', ext):
+            ext = ''
+        entry = {'url': url, 'sha256': sha256, 'size': size,
+                 'type': mime or mimetypes.guess_type(url)[0], 'ext': ext}
+
+        with self._lock:
+            is_new = sha256 not in self.hashes
+            target = os.path.join(self.folder, self.relpath(entry))
+            if is_new and not os.path.isfile(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(tmppath, target)
+            else:
+                os.remove(tmppath)
+            self.hashes.add(sha256)
+            self.entries[url] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        return is_new
+
+
+class AttachmentDownloader:
+    """Download files to disk on a pool of background threads.
+
+    Downloads are queued with submit() and run while the caller goes on
+    with its own work; submit() only blocks when the queue is full. Bodies
+    are streamed to '<file>.part' in chunks and renamed into place once
+    complete, so a file on disk is always whole. An interrupted download
+    leaves the '.part' file behind and is resumed with an HTTP Range
+    request by the next attempt, in this run or the next one.
+
+    With a manifest, finished files go into its content-addressed store
+    instead of to the path given to submit().
+    """
+    CHUNK_SIZE = 64 * 1024
+    ATTEMPTS = 3
+
+    def __init__(self, fetch, logger, workers=4, rate=None, manifest=None):
+        """fetch(url, headers) must return a streamed requests.Response;
+        rate, if given, is a RateController that admits every request"""
+        self.fetch = fetch
+        self.logger = logger
+        self.rate = rate
+        self.manifest = manifest
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers * 4)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._cancelled = False
+        self._futures = []
+        self.failed = []
+        self.bytes_downloaded = 0
+
+    def submit(self, url, diskpath, key=None):
+        """Queue url for download to diskpath, unless it is already queued.
+        With a manifest, the file is recorded there under key (the URL
+        without the server part), and diskpath is only used for staging.
+        Returns the future of the download (of the queued one, if any),
+        which is done once the download has finished or failed, or is
+        cancelled if the downloader is shut down."""
+        self._slots.acquire()
+        with self._lock:
+            future = self._pending.get(diskpath)
+            if future is None and self._cancelled:
+                future = concurrent.futures.Future()
+                future.cancel()
+            if future is not None:
+                self._slots.release()
+                return future
+            future = self._pool.submit(self._download, url, diskpath, key)
+            self._pending[diskpath] = future
+            self._futures.append(future)
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def join(self):
+        """Wait for all queued downloads and shut the pool down"""
+        with self._lock:
+            futures = list(self._futures)
+        concurrent.futures.wait(futures)
+        self._pool.shutdown()
+
+    def cancel(self):
+        """Drop the queued downloads and shut the pool down without waiting.
+        Downloads that are running are finished, later submits are ignored."""
+        with self._lock:
+            self._cancelled = True
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _request(self, url, headers):
+        if self.rate is None:
+            return self.fetch(url, headers)
+        return self.rate.request(lambda: self.fetch(url, headers), 'attachment ' + url,
+                                 kind='attachment')
+
+    def _download(self, url, diskpath, key):
+        try:
+            for attempt in range(1, self.ATTEMPTS + 1):
+                try:
+                    if self._download_once(url, diskpath, key):
+                        self.logger.debug('Downloaded attachment: ' + url + ' --> ' + diskpath)
+                    return
+                except (requests.ConnectionError, requests.Timeout) as err:
+                    self.logger.warning('Download of %s interrupted (%s), attempt %d',
+                                        url, err, attempt)
+            self.logger.warning('Failed to download: ' + url)
+            self.failed.append(url)
+        except Exception:
+            if self._cancelled:
+                # interrupted, the '.part' file is resumed by the next run
+                self.logger.debug('Download of %s interrupted', url)
+                return
+            self.logger.exception('Failed to download: ' + url)
+            self.failed.append(url)
+        finally:
+            with self._lock:
+                self._pending.pop(diskpath, None)
+
+    def _download_once(self, url, diskpath, key):
+        partpath = diskpath + '.part'
+        digest = hashlib.sha256()
+
+        # the '.part' file stays open (and locked) until it is in place, so
+        # another export writing to the same folder leaves it alone
+        with open(partpath, 'a+b') as part:
+            if not try_lock(part):
+                self.logger.debug('%s is being downloaded by another process', url)
+                return False
+
+            try:
+                while True:
+                    offset = part.seek(0, os.SEEK_END)
+                    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+                    response = self._request(url, headers)
+                    if response.status_code == 416 and offset:
+                        # the partial file does not fit the server's copy any more
+                        response.close()
+                        part.truncate(0)
+                        continue
+                    break
+
+                with response:
+                    if response.status_code == 206 and offset:
+                        self.logger.debug('Resuming %s at byte %d', url, offset)
+                        if self.manifest is not None:
+                            part.seek(0)
+                            for chunk in iter(lambda: part.read(self.CHUNK_SIZE), b''):
+                                digest.update(chunk)
+                    elif response.status_code == 200:
+                        part.truncate(0)
+                        offset = 0
+                    else:
+                        self.logger.warning('Failed to download: %s (HTTP %d)',
+                                            url, response.status_code)
+                        self.failed.append(url)
+                        return False
+
+                    for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                        part.write(chunk)
+                        digest.update(chunk)
+                    part.flush()
+                    size = part.tell()
+                    with self._lock:
+                        self.bytes_downloaded += size - offset
+
+                if self.manifest is not None:
+                    mime = response.headers.get('Content-Type', '').split(';')[0] or None
+                    if not self.manifest.store(key, partpath, digest.hexdigest(), size, mime):
+                        self.logger.debug('Attachment %s has the same content as a stored file', url)
+                else:
+                    os.replace(partpath, diskpath)
+            finally:
+                # a download that failed before anything arrived leaves no
+                # empty '.part' file behind
+                if os.path.isfile(partpath) and part.seek(0, os.SEEK_END) == 0:
+                    os.remove(partpath)
+        return True
+
+
+class JsonHistoryWriter:
+    """Writes the messages of a window to a history file as
+    {"messages": [...], "success": true}, one message at a time.
+
+    The messages go to '<file>.tmp', which replaces the history file when
+    the writer is closed, so a history file is never left half written:
+    after an interruption it is either missing or as it was before.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path + '.tmp', 'w', encoding='utf-8')
+        self._file.write('{"messages": [')
+
+    def write(self, message):
+        if self.count > 0:
+            self._file.write(',\n')
+        self._file.write(json.dumps(message, ensure_ascii=False))
+        self.count += 1
+
+    def close(self):
+        self._file.write('], "success": true}')
+        self._file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def abort(self):
+        """Drop what was written, leaving the history file as it was"""
+        self._file.close()
+        os.remove(self.path + '.tmp')
+
+
+def history_file_complete(path):
+    """Cheap check that a JSON history file was written completely: it
+    must end the way API responses and JsonHistoryWriter files do, with
+    '"success": true}'. Only the last bytes of the file are read."""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(max(0, f.seek(0, os.SEEK_END) - 64))
+            tail = f.read()
+    except OSError:
+        return False
+    return re.search(rb'"success"\s*:\s*true\s*}\s*$', tail) is not None
+
+
+class HistoryArchive:
+    """Compressed JSON Lines history files, one per room and month.
+
+    '<YYYY-MM>-<room>.jsonl.gz' (or '.zst') holds one message per line.
+    Every window (a day, or a month with month_blocks) is a compressed
+    member (frame) of its own, and '<file>.idx' maps each window to the
+    offset, length and message count of its member, so a window can be
+    read without decompressing the rest of the month. Writing a window
+    again replaces its member. The index also holds the CRC-32 of every
+    member, so an entry that does not fit the archive file (after a crash
+    between compacting the file and writing its index) is recognized.
+    """
+    def __init__(self, output_dir, compression='gz'):
+        if compression not in ('gz', 'zst'):
+            raise ValueError('Unknown archive compression: ' + compression)
+        if compression == 'zst' and zstandard is None:
+            raise RuntimeError('history_format = jsonl.zst needs the zstandard package')
+        self.output_dir = output_dir
+        self.compression = compression
+
+    def path(self, window, room_name):
+        return (self.output_dir + window[:7] + '-' + re.sub(r'\s+', '_', room_name)
+                + '.jsonl.' + self.compression)
+
+    def has_window(self, window, room_name):
+        """Whether window is in the archive: the bytes its index entry
+        points to must be the member that was written"""
+        path = self.path(window, room_name)
+        entry = read_archive_index(path).get(window)
+        if entry is None:
+            return False
+        try:
+            with open(path, 'rb') as f:
+                return member_intact(f, entry)
+        except OSError:
+            return False
+
+    def read_window(self, window, room_name):
+        """Messages of a single window"""
+        path = self.path(window, room_name)
+        offset, length = read_archive_index(path)[window][:2]
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return decode_archive_member(f.read(length), path)
+
+    def open_window(self, window, room_name):
+        """Return a writer for the messages of window; the window is only
+        added to the index once the writer is closed"""
+        return ArchiveWindowWriter(self.path(window, room_name), window, self.compression)
+
+
+class ArchiveWindowWriter:
+    """Appends one window to an archive file, see HistoryArchive"""
+    def __init__(self, path, window, compression):
+        self.path = path
+        self.window = window
+        self.count = 0
+        self._file = open(path, 'ab')
+        self._offset = self._file.seek(0, os.SEEK_END)
+        if compression == 'zst':
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._file, closefd=False)
+        else:
+            self._stream = gzip.GzipFile(fileobj=self._file, mode='wb')
+
+    def write(self, message):
+        self._stream.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+        self.count += 1
+
+    def abort(self):
+        """Drop the member written so far; the archive keeps its windows"""
+        self._stream.close()
+        self._file.truncate(self._offset)
+        self._file.close()
+
+    def close(self):
+        self._stream.close()
+        length = self._file.tell() - self._offset
+        self._file.close()
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            checksum = zlib.crc32(f.read(length))
+
+        index = read_archive_index(self.path)
+        replaced = self.window in index
+        index[self.window] = [self._offset, length, self.count, checksum]
+        if replaced:
+            index = compact_archive(self.path, index)
+        write_archive_index(self.path, index)
+
+
+def read_archive_index(path):
+    if not os.path.isfile(path + '.idx'):
+        return {}
+    with open(path + '.idx', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_archive_index(path, index):
+    with open(path + '.idx.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, sort_keys=True)
+    os.replace(path + '.idx.tmp', path + '.idx')
+
+
+def member_intact(f, entry):
+    """Whether the index entry of a member fits the open archive file f.
+    Entries written before checksums were kept only have to lie within
+    the file."""
+    offset, length = entry[0], entry[1]
+    if offset + length > os.fstat(f.fileno()).st_size:
+        return False
+    if len(entry) < 4:
+        return True
+    f.seek(offset)
+    return zlib.crc32(f.read(length)) == entry[3]
+
+
+def compact_archive(path, index):
+    """Copy the members listed in index to a new archive file, dropping
+    the ones that were replaced, and any whose entry does not fit the
+    file (those windows are exported again). Returns the index of the
+    new file."""
+    compacted = {}
+    with open(path, 'rb') as fin, open(path + '.tmp', 'wb') as fout:
+        for window in sorted(index):
+            if not member_intact(fin, index[window]):
+                continue
+            offset, length, count = index[window][:3]
+            fin.seek(offset)
+            data = fin.read(length)
+            compacted[window] = [fout.tell(), length, count, zlib.crc32(data)]
+            fout.write(data)
+    os.replace(path + '.tmp', path)
+    return compacted
+
+
+def read_archive(path):
+    """Yield (window, messages) for every window of an archive file,
+    in window order. Windows whose entry does not fit the file (see
+    member_intact) are left out."""
+    index = read_archive_index(path)
+    with open(path, 'rb') as f:
+        for window in sorted(index):
+            if not member_intact(f, index[window]):
+                continue
+            offset, length = index[window][:2]
+            f.seek(offset)
+            yield window, decode_archive_member(f.read(length), path)
+
+
+def decode_archive_member(data, path):
+    """Messages of one compressed member of the archive file path"""
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('Reading ' + path + ' needs the zstandard package')
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    else:
+        data = gzip.decompress(data)
+    return [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+
+
+def index_history_dir(input_dir):
+    """Map every channel to the (window start, file name) of its history
+    files, in the order of their windows. Month files and archives start
+    on the 1st of their month. The directory is listed only once for all
+    channels."""
+    index = {}
+    for filename in os.listdir(input_dir):
+        match = HISTORY_FILE_RE.match(filename)
+        if match:
+            day = '01' if match.group(2) == 'NN' else match.group(2)
+            index.setdefault(match.group(3), []).append((match.group(1) + '-' + day, filename))
+            continue
+
+        # compressed archives (history_format = jsonl.gz) hold a month
+        match = ARCHIVE_FILE_RE.match(filename)
+        if match:
+            index.setdefault(match.group(2), []).append((match.group(1) + '-01', filename))
+
+    for files in index.values():
+        files.sort()
+    return index
+
+
+def load_history_file(path):
+    """Messages of a history file in either format"""
+    if ARCHIVE_FILE_RE.match(os.path.basename(path)):
+        messages = []
+        for _, window_messages in read_archive(path):
+            messages += window_messages
+        return messages
+
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)['messages']
+
+
+class MessageIdIndex:
+    """Persistent index from message id to a summary of the message
+    (room, timestamp, author and text), kept in an SQLite database next to
+    the history files. export-history.py adds every message it writes, so
+    html-convert.py can show the original of a reply with a single lookup,
+    wherever in the history of the room that message is.
+
+    A sharded export writes an index per shard; merge() adds the messages
+    of those to the main one, which a shard consults (as 'fallback') for
+    messages exported before it existed.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            room TEXT NOT NULL,
+            ts TEXT NOT NULL,
+            username TEXT,
+            name TEXT,
+            msg TEXT
+        );
+    """
+
+    def __init__(self, path, readonly=False, fallback=None):
+        self.path = path
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        if readonly:
+            self.db = sqlite3.connect('file:' + urllib.parse.quote(os.path.abspath(path)) + '?mode=ro',
+                                      uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(self.SCHEMA)
+
+    def add(self, messages, room):
+        rows = [(m['_id'], room, m['ts'], m.get('u', {}).get('username'),
+                 m.get('u', {}).get('name'), m.get('msg', ''))
+                for m in messages if '_id' in m]
+        with self._lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO messages (id, room, ts, username, name, msg) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.db.execute('COMMIT')
+
+    def remove(self, message_ids):
+        with self._lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('DELETE FROM messages WHERE id = ?',
+                                [(message_id,) for message_id in message_ids])
+            self.db.execute('COMMIT')
+
+    def merge(self, path):
+        """Add all messages of the index at path"""
+        with self._lock:
+            self.db.execute('ATTACH DATABASE ? AS other', (path,))
+            try:
+                self.db.execute('BEGIN')
+                try:
+                    self.db.execute('INSERT OR REPLACE INTO messages (id, room, ts, username, name, msg) '
+                                    'SELECT id, room, ts, username, name, msg FROM other.messages')
+                    self.db.execute('COMMIT')
+                except BaseException:
+                    self.db.execute('ROLLBACK')
+                    raise
+            finally:
+                self.db.execute('DETACH DATABASE other')
+
+    def get(self, message_id):
+        """Summary of a message in the form of a message ('msg', 'ts' and
+        'u' with 'username' and 'name'), or None"""
+        with self._lock:
+            row = self.db.execute('SELECT ts, username, name, msg FROM messages WHERE id = ?',
+                                  (message_id,)).fetchone()
+        if row is None:
+            if self.fallback is not None:
+                return self.fallback.get(message_id)
+            return None
+        return {'ts': row[0], 'u': {'username': row[1], 'name': row[2]}, 'msg': row[3]}
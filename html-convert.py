@@ -12,86 +12,184 @@ Dependencies:
 
 Commands:
     pipenv run python html-convert.py channel-name
+    pipenv run python html-convert.py --all
+    pipenv run python html-convert.py --all --incremental
+    pipenv run python html-convert.py --all --paged --incremental
 
 """
 
+import re
 import json
+import heapq
+import collections
+import concurrent.futures
+import html
+import shutil
+import hashlib
 import datetime
+import time
 import os
 import logging
 import pprint
 import argparse
 import configparser
-import requests
-import urllib
+import urllib.parse
 import markdown
-import re   
+from history_common import AttachmentDownloader, AttachmentManifest, attachment_diskname, login_headers, make_session
+from history_common import MessageIdIndex, index_history_dir, load_history_file
 
-def main():
+# number of recent messages kept for looking up the original of a reply
+RECENT_MESSAGES = 10000
 
-    argparser_main = argparse.ArgumentParser()
-    argparser_main.add_argument('--config',
-                                help='Location of configuration file')
-    
-    argparser_main.add_argument('channel',
-                                help='Name of the channel to export')
+# stored in the manifest of incremental builds; fragments of a build
+# with another version are not reused
+FRAGMENT_VERSION = 3
 
-    args = argparser_main.parse_args()
+# number of rendered messages kept, so quoted messages are rendered once
+RENDERED_MESSAGES = 10000
 
-    logger = logging.getLogger('html-export')    
-    logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    logger.addHandler(ch)
+# text that Markdown would only wrap in a paragraph: words separated by
+# single spaces and punctuation, not starting like a numbered list
+PLAIN_TEXT = re.compile(r"(?!\d+[.)] )[^\W_](?:[^\W_]| (?! )|[,.;:?!'\"])*(?<! )")
 
-    config = configparser.ConfigParser()
-    config.read( args.config if args.config else 'settings.cfg' )
 
-    input_dir = config['files']['history_output_dir']
+def message_ts(m):
+    return m['ts']
 
-    rc_user = config['rc-api']['user']
-    rc_pass = config['rc-api']['pass']
-    rc_server = config['rc-api']['server']
 
-    file_prefix = config.get('files','file_prefix', fallback='');
-    file_folder = config.get('files','file_folder', fallback='attachments');
+def stream_messages(input_dir, files):
+    """Yield the messages of the history files in timestamp order.
 
-    logger.debug("Input folder: "+input_dir)
+    Only one file is read at a time and sorted on its own. Files are
+    merged only where their windows overlap (a month file next to day
+    files of the same month), so memory is bounded by the largest window
+    instead of the whole channel."""
+    pending = []
+    horizon = ''
 
-    outfile = open( args.channel+'.html', 'w')
-    
-    outfile.write('<!DOCTYPE html><html><head><meta charset="utf-8" />')
-    outfile.write('<title>Export Rocketchat channel "'+args.channel+'"</title>')
-    outfile.write('<link rel="stylesheet" href="simple.css" />');
-    outfile.write('</head><body>\n')
+    for window_start, filename in files:
+        if pending and window_start > horizon:
+            yield from heapq.merge(*pending, key=message_ts)
+            pending = []
 
-    messages = []
+        messages = sorted(load_history_file(input_dir + filename), key=message_ts)
+        if messages:
+            pending.append(messages)
+            horizon = max(horizon, messages[-1]['ts'])
 
-    for filename in sorted( os.listdir(input_dir) ):
-        if not filename[11:-5] == args.channel:
-            continue
+    yield from heapq.merge(*pending, key=message_ts)
 
-        data = json.load( open( input_dir + filename ))
-        messages += data['messages']
 
-    if len(messages) == 0:
-        print("No messages found for channel: "+args.channel)
-        return
-       
-    message_dict = {}
-    for m in messages:
-        message_dict[m.get('_id','null')] = m
+class MessageLookup:
+    """The messages a reply can quote. Thread parents (messages with a
+    'tcount') are kept for the whole channel, other messages only while
+    they are among the last RECENT_MESSAGES seen. Messages not found there
+    are looked up in the message id index of export-history.py, if any."""
 
-    # sort messages by timestamp
-    messages = sorted( messages, key=lambda ts: ts['ts'])
- 
+    def __init__(self, size=RECENT_MESSAGES, index=None):
+        self.size = size
+        self.index = index
+        self.parents = {}
+        self.recent = collections.OrderedDict()
 
-    for m in messages:
+    def add(self, m):
+        key = m.get('_id', 'null')
+        summary = {'msg': m.get('msg', ''), 'u': m['u'], 'ts': m['ts']}
+
+        if 'tcount' in m:
+            self.parents[key] = summary
+        else:
+            self.recent[key] = summary
+            self.recent.move_to_end(key)
+            if len(self.recent) > self.size:
+                self.recent.popitem(last=False)
+
+    def get(self, key):
+        if key in self.parents:
+            return self.parents[key]
+        if key in self.recent:
+            return self.recent[key]
+        if self.index is not None:
+            return self.index.get(key)
+        return None
+
+
+class HtmlRenderer:
+    """Writes the HTML of single messages. prepare() has to be called
+    with the history files before their messages are written."""
+
+    def __init__(self, config, logger, offline=False):
+        self.config = config
+        self.logger = logger
+        self.offline = offline
+        self.input_dir = config['files']['history_output_dir']
+        self.rc_server = config['rc-api']['server']
+        self.file_prefix = config.get('files','file_prefix', fallback='')
+        self.file_folder = config.get('files','file_folder', fallback='attachments')
+        self.avatar_folder = config.get('files','avatar_folder', fallback='avatar')
+
+        # replies to messages outside of what is being rendered are found
+        # through the message id index written by export-history.py
+        self.message_index = None
+        message_index = config.get('files', 'message_index',
+                                   fallback=self.input_dir + 'message-index.sqlite')
+        if message_index and os.path.isfile(message_index):
+            self.message_index = MessageIdIndex(message_index, readonly=True)
+
+        # attachments stored by export-history.py with content_addressed = True
+        # are found through the manifest of the store
+        self.manifest = None
+        if config.getboolean('files', 'content_addressed', fallback=False):
+            self.manifest = AttachmentManifest(self.input_dir + self.file_folder)
+
+        # only logged in once a missing attachment has to be downloaded
+        self.session = None
+        self.auth_headers = {}
+        self.download_concurrency = config.getint('rc-api', 'download_concurrency', fallback=4)
+        # attachments that failed to download are not tried again for
+        # failure_ttl seconds, see download()
+        self.failure_ttl = config.getfloat('files', 'attachment_failure_ttl_hours',
+                                           fallback=24) * 3600
+
+        # attachment files known to be on disk, see prepare()
+        self.checked = set()
+        self.available = set()
+        self.avatars = None
+
+        # one converter for all messages, setting it up is the expensive part
+        self.md = markdown.Markdown()
+        self.rendered = collections.OrderedDict()
+
+    def render(self, text, key=None):
+        """Markdown to HTML. The result is remembered under key (the
+        message id) for the last RENDERED_MESSAGES messages."""
+        if key is not None and key in self.rendered:
+            self.rendered.move_to_end(key)
+            return self.rendered[key]
+
+        if PLAIN_TEXT.fullmatch(text):
+            result = '<p>' + text + '</p>'
+        else:
+            result = self.md.reset().convert(text)
+
+        if key is not None:
+            self.rendered[key] = result
+            if len(self.rendered) > RENDERED_MESSAGES:
+                self.rendered.popitem(last=False)
+        return result
+
+    def write_header(self, outfile, channel):
+        outfile.write('<!DOCTYPE html><html><head><meta charset="utf-8" />')
+        outfile.write('<title>Export Rocketchat channel "'+channel+'"</title>')
+        outfile.write('<link rel="stylesheet" href="simple.css" />');
+        outfile.write('</head><body>\n')
+
+    def write_message(self, outfile, m, lookup):
         outfile.write('<div class="message">\n')
         
         # the avatar
-        avatar_file =  input_dir + '/avatar/' +  m['u']['username'] + '.jpg'
-        if os.path.isfile( avatar_file ):
+        avatar_file =  self.input_dir + self.avatar_folder + '/' +  m['u']['username'] + '.jpg'
+        if m['u']['username'] + '.jpg' in self.avatars:
             outfile.write('<div class="avatar"><img class="avatar" src="' + avatar_file + '" /></div>')
         
         # full name
@@ -110,17 +208,17 @@ def main():
                 outfile.write('<div class="room_event">has joined the room</div>')
         else:
             # the actual message
-            outfile.write('<div class="content">' + markdown.markdown(m['msg']) + '</div>\n')
+            outfile.write('<div class="content">' + self.render(m['msg'], m.get('_id')) + '</div>\n')
 
 
 
         # handling replies
         if 'tmid' in m:
             rply = m.get("tmid")
+            n = lookup.get(rply)
             outfile.write('<div class="reply">')
-            if rply in message_dict:
-                n = message_dict[rply]
-                outfile.write('<div class="reply_message">' + markdown.markdown(n['msg']) + '</div>\n') 
+            if n is not None:
+                outfile.write('<div class="reply_message">' + self.render(n['msg'], rply) + '</div>\n') 
                 outfile.write('<div class="reply_user">' + n['u']['name'] + '</div>\n')
                 outfile.write('<div class="reply_stamp">' +"("+n['u']['username'] +") " 
                     + n['ts'][:10]+' ' +n['ts'][11:19]  +'</div>\n')
@@ -136,31 +234,11 @@ def main():
 
             if 'title_link' in a:
                 urlname = a.get('title_link')
-                diskname = urlname
-
-                if urlname.startswith(file_prefix):
-                    diskname = urlname[len(file_prefix):]
-                        
-                diskname = urllib.parse.unquote(diskname)
-                diskname = re.sub('\s+|\:','_',diskname)                             
 
-                diskname = diskname.replace('/','-')
+                diskpath = self.attachment_path(urlname)
 
-                diskpath = input_dir + file_folder +'/'+ diskname
-
-                if not os.path.isfile( diskpath ):
-                    req = requests.get(rc_server + urlname,
-                        headers={ 'X-Auth-Token': rc_pass , 'X-User-Id': rc_user })
-
-                    if req.status_code == 200 :
-                        fout = open( diskpath, 'wb')
-                        fout.write( req.content )
-                        logger.debug('Downloaded: ' +urlname+' --> '+diskname)
-                    else:
-                        logger.warn('Failed download: '+urlname)
-
-                # no 'else' here, have to check if file was downloaded
-                if os.path.isfile(diskpath):
+                # missing files were downloaded by prepare(), if possible
+                if diskpath in self.available:
                     outfile.write('<div class="attachment"><a href="'
                         + diskpath+'">'
                         + os.path.basename(urllib.parse.unquote(urlname))
@@ -168,15 +246,470 @@ def main():
                     
                     # include preview image
                     if 'image_type' in a:
-                        outfile.write('<div class="preview"><img class="preview" src="'
+                        outfile.write('<div class="preview"><img class="preview" loading="lazy" src="'
                             + diskpath + '"></div>')
 
+        outfile.write('</div>\n')
 
+    def missing_files(self, m):
+        """Attachments (URLs) and avatars (usernames) of a message that
+        write_message had to leave out, as they are not on disk"""
+        attachments = [a['title_link'] for a in m.get('attachments', []) if 'title_link' in a
+                       and self.attachment_path(a['title_link']) not in self.available]
+        avatars = [] if m['u']['username'] + '.jpg' in self.avatars else [m['u']['username']]
+        return attachments, avatars
+
+    def attachment_path(self, urlname):
+        """Path of the attachment on disk, None if it is not in the store"""
+        if self.manifest is not None:
+            entry = self.manifest.get(urlname)
+            if entry is None:
+                return None
+            return self.input_dir + self.file_folder + '/' + self.manifest.relpath(entry)
+
+        diskname = attachment_diskname(urlname, self.file_prefix)
+        return self.input_dir + self.file_folder +'/'+ diskname
+
+    def load_avatars(self):
+        """List the avatar folder once"""
+        if self.avatars is None:
+            avatar_dir = self.input_dir + self.avatar_folder
+            self.avatars = set(os.listdir(avatar_dir)) if os.path.isdir(avatar_dir) else set()
+
+    def found_missing(self, missing):
+        """Whether any of the attachments (URLs) or avatars (usernames) in
+        missing, as recorded by build_fragments, is on disk now. Only looks
+        at the disk, nothing is downloaded."""
+        self.load_avatars()
+        for urlname in missing['attachments']:
+            diskpath = self.attachment_path(urlname)
+            if diskpath is not None and os.path.isfile(diskpath):
+                self.available.add(diskpath)
+                return True
+        return any(username + '.jpg' in self.avatars for username in missing['avatars'])
+
+    def prepare(self, files, failed=None):
+        """Find the attachments of the history files that are on disk and
+        download the missing ones on a pool of threads (unless offline),
+        so that writing messages needs no disk or network access. See
+        download() for failed."""
+        self.load_avatars()
+
+        missing = {}
+        for _, filename in files:
+            for m in load_history_file(self.input_dir + filename):
+                for a in m.get('attachments', []):
+                    urlname = a.get('title_link')
+                    if urlname is None or urlname in self.checked:
+                        continue
+                    self.checked.add(urlname)
+
+                    diskpath = self.attachment_path(urlname)
+                    if diskpath is None:
+                        self.logger.warning('Not in attachment store (run export-history.py): '+urlname)
+                    elif os.path.isfile(diskpath):
+                        self.available.add(diskpath)
+                    elif self.manifest is None:
+                        missing[urlname] = diskpath
+
+        self.download(missing, failed)
+
+    def download(self, missing, failed=None):
+        """Download the attachments in missing (URL -> path on disk) unless
+        offline. failed maps URLs to the time their download last failed;
+        those that failed less than failure_ttl ago are skipped, and the
+        outcome of the others is recorded in it. The session only logs in
+        once something is left to download."""
+        if failed is not None:
+            now = time.time()
+            missing = {urlname: diskpath for urlname, diskpath in missing.items()
+                       if now - failed.get(urlname, 0) >= self.failure_ttl}
+        if not missing:
+            return
+        if self.offline:
+            self.logger.info('Offline, not downloading %d missing attachments', len(missing))
+            return
+
+        if self.session is None:
+            self.session = make_session(self.config, pool_size=self.download_concurrency)
+            self.auth_headers = login_headers(self.config, self.session)
+
+        def fetch(url, headers):
+            return self.session.get(url, headers={**self.auth_headers, **headers}, stream=True)
+
+        downloader = AttachmentDownloader(fetch, self.logger, workers=self.download_concurrency)
+        for urlname, diskpath in missing.items():
+            downloader.submit(self.rc_server + urlname, diskpath)
+        downloader.join()
+
+        for urlname, diskpath in missing.items():
+            if os.path.isfile(diskpath):
+                self.available.add(diskpath)
+                if failed is not None:
+                    failed.pop(urlname, None)
+            elif failed is not None:
+                failed[urlname] = time.time()
+
+
+def convert_channel(renderer, channel, files):
+    """Write '<channel>.html' from the history files of the channel and
+    return the number of messages in it"""
+    # messages are written as they are read, so a channel never has to
+    # fit into memory as a whole
+    lookup = MessageLookup(index=renderer.message_index)
+    count = 0
+
+    renderer.prepare(files)
+
+    with open( channel+'.html', 'w') as outfile:
+        renderer.write_header(outfile, channel)
+
+        for m in stream_messages(renderer.input_dir, files):
+            lookup.add(m)
+            renderer.write_message(outfile, m, lookup)
+            count += 1
+
+    return count
+
+
+def file_fingerprint(path, known=None):
+    """Size, mtime and SHA-256 of a file. The hash is taken over from
+    known if size and mtime did not change."""
+    st = os.stat(path)
+    if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime_ns:
+        return known
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': digest.hexdigest()}
+
+
+def write_atomic(path, text):
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def build_fragments(renderer, channel, files, build_dir, rebuild=False):
+    """Render the HTML of every month of a channel into a fragment in
+    '<build_dir>/<channel>/'. Unless rebuild is set, only the months whose
+    history files changed since the last build are rendered.
+
+    'manifest.json' there records the size, mtime and hash of every
+    history file, which files each fragment was made from and which
+    attachments and avatars it had to leave out. A fragment that left
+    something out is rendered again once that is on disk, or once a
+    missing attachment could be downloaded. Attachments that failed to
+    download are listed under 'failed' and only tried again after the
+    renderer's failure_ttl, so a file that is gone for good costs no
+    requests on every build. The thread
+    parents of each month are stored next to its fragment, so replies to
+    them from later months can be resolved without rendering the month
+    again. If they change, the later months are rendered again as well.
+    Replies to other messages are only resolved within their month, or
+    through the message id index of export-history.py.
+
+    Returns the folder and an ordered dict with the 'count', 'first' and
+    'last' message timestamp of every month."""
+    folder = os.path.join(build_dir, channel)
+    os.makedirs(folder, exist_ok=True)
+    manifest_path = os.path.join(folder, 'manifest.json')
+
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    if manifest.get('version') != FRAGMENT_VERSION:
+        manifest = {}
+    known_files = manifest.get('files', {})
+    failed = dict(manifest.get('failed', {}))
+    known_months = {} if rebuild else manifest.get('months', {})
+
+    months = collections.OrderedDict()
+    for window_start, filename in files:
+        months.setdefault(window_start[:7], []).append((window_start, filename))
+
+    fingerprints = {}
+    built_months = collections.OrderedDict()
+    parents = {}
+    parents_changed = False
+    rendered = 0
+
+    for month, month_files in months.items():
+        sources = {}
+        for _, filename in month_files:
+            fingerprints[filename] = file_fingerprint(renderer.input_dir + filename,
+                                                      known_files.get(filename))
+            sources[filename] = fingerprints[filename]['sha256']
+
+        fragment_path = os.path.join(folder, month + '.html')
+        parents_path = os.path.join(folder, month + '.parents.json')
+        known = known_months.get(month)
+
+        old_parents = None
+        if os.path.isfile(parents_path):
+            with open(parents_path) as f:
+                old_parents = json.load(f)
+
+        if (not parents_changed and known is not None and known['files'] == sources
+                and old_parents is not None and os.path.isfile(fragment_path)):
+            # e.g. rendered --offline: see whether what it left out is there now
+            missing = known['missing']
+            found = renderer.found_missing(missing)
+            if not found and missing['attachments'] and renderer.manifest is None:
+                renderer.download({url: renderer.attachment_path(url)
+                                   for url in missing['attachments']}, failed)
+                found = renderer.found_missing(missing)
+            if not found:
+                parents.update(old_parents)
+                built_months[month] = known
+                continue
+
+        renderer.prepare(month_files, failed)
+
+        lookup = MessageLookup(index=renderer.message_index)
+        lookup.parents = dict(parents)
+        month_count = 0
+        first = last = None
+        missing_attachments = set()
+        missing_avatars = set()
+
+        with open(fragment_path + '.tmp', 'w') as outfile:
+            for m in stream_messages(renderer.input_dir, month_files):
+                lookup.add(m)
+                renderer.write_message(outfile, m, lookup)
+                attachments, avatars = renderer.missing_files(m)
+                missing_attachments.update(attachments)
+                missing_avatars.update(avatars)
+                month_count += 1
+                first = first or m['ts']
+                last = m['ts']
+        os.replace(fragment_path + '.tmp', fragment_path)
+
+        month_parents = {key: summary for key, summary in lookup.parents.items()
+                         if key not in parents}
+        if month_parents != old_parents:
+            write_atomic(parents_path, json.dumps(month_parents))
+            parents_changed = True
+        parents.update(month_parents)
+
+        built_months[month] = {'files': sources, 'count': month_count,
+                               'first': first, 'last': last,
+                               'missing': {'attachments': sorted(missing_attachments),
+                                           'avatars': sorted(missing_avatars)}}
+        rendered += 1
+
+    # fragments of months that have no history files any more
+    for month in set(manifest.get('months', {})) - set(built_months):
+        for name in (month + '.html', month + '.parents.json'):
+            if os.path.isfile(os.path.join(folder, name)):
+                os.remove(os.path.join(folder, name))
+
+    now = time.time()
+    failed = {urlname: when for urlname, when in failed.items()
+              if now - when < renderer.failure_ttl}
+    write_atomic(manifest_path, json.dumps({'version': FRAGMENT_VERSION,
+                                            'files': fingerprints,
+                                            'months': built_months,
+                                            'failed': failed}))
+
+    renderer.logger.debug('%s: rendered %d of %d months', channel, rendered, len(built_months))
+    return folder, built_months
+
+
+def convert_channel_incremental(renderer, channel, files, build_dir):
+    """Like convert_channel, but only renders the months whose history
+    files changed since the last build (see build_fragments) and
+    assembles the page from the stored fragments"""
+    folder, months = build_fragments(renderer, channel, files, build_dir)
+
+    with open(channel + '.html.tmp', 'w') as outfile:
+        renderer.write_header(outfile, channel)
+        for month in months:
+            with open(os.path.join(folder, month + '.html')) as fragment:
+                shutil.copyfileobj(fragment, outfile)
+    os.replace(channel + '.html.tmp', channel + '.html')
+
+    return sum(month['count'] for month in months.values())
+
+
+def month_page(channel, month):
+    return channel + '-' + month + '.html'
+
+
+def write_month_nav(outfile, channel, months, i):
+    outfile.write('<div class="nav"><a href="' + urllib.parse.quote(channel) + '.html">'
+        + html.escape(channel) + '</a>')
+    if i > 0:
+        outfile.write(' <a href="' + urllib.parse.quote(month_page(channel, months[i - 1])) + '">&laquo; '
+            + months[i - 1] + '</a>')
+    if i < len(months) - 1:
+        outfile.write(' <a href="' + urllib.parse.quote(month_page(channel, months[i + 1])) + '">'
+            + months[i + 1] + ' &raquo;</a>')
+    outfile.write('</div>\n')
+
+
+def convert_channel_paged(renderer, channel, files, build_dir, incremental):
+    """Write one page per month ('<channel>-YYYY-MM.html') with links to
+    the previous and next month, '<channel>.html' listing the months, and
+    '<channel>.json', an index of the months for viewers that load them
+    on demand. The months are rendered with build_fragments."""
+    folder, months = build_fragments(renderer, channel, files, build_dir,
+                                     rebuild=not incremental)
+    names = list(months)
+
+    for i, month in enumerate(names):
+        path = month_page(channel, month)
+        with open(path + '.tmp', 'w') as outfile:
+            renderer.write_header(outfile, channel + ' ' + month)
+            write_month_nav(outfile, channel, names, i)
+            with open(os.path.join(folder, month + '.html')) as fragment:
+                shutil.copyfileobj(fragment, outfile)
+            write_month_nav(outfile, channel, names, i)
+            outfile.write('</body></html>\n')
+        os.replace(path + '.tmp', path)
+
+    with open(channel + '.html.tmp', 'w') as outfile:
+        renderer.write_header(outfile, channel)
+        outfile.write('<ul class="months">\n')
+        for month in names:
+            outfile.write('<li><a href="' + urllib.parse.quote(month_page(channel, month)) + '">'
+                + month + '</a> (' + str(months[month]['count']) + ' messages)</li>\n')
+        outfile.write('</ul>\n</body></html>\n')
+    os.replace(channel + '.html.tmp', channel + '.html')
+
+    write_atomic(channel + '.json', json.dumps({
+        'channel': channel,
+        'count': sum(month['count'] for month in months.values()),
+        'months': [{'month': month, 'page': month_page(channel, month),
+                    'count': months[month]['count'],
+                    'first': months[month]['first'], 'last': months[month]['last']}
+                   for month in names]}, indent=1))
+
+    return sum(month['count'] for month in months.values())
+
+
+def write_index(channels):
+    """Write 'index.html' linking the page of every channel.
+    channels is a list of (channel, message count)"""
+    with open('index.html', 'w') as outfile:
+        outfile.write('<!DOCTYPE html><html><head><meta charset="utf-8" />')
+        outfile.write('<title>Export Rocketchat channels</title>')
+        outfile.write('<link rel="stylesheet" href="simple.css" />')
+        outfile.write('</head><body>\n<ul class="channels">\n')
+        for channel, count in channels:
+            outfile.write('<li><a href="' + urllib.parse.quote(channel) + '.html">'
+                + html.escape(channel) + '</a> (' + str(count) + ' messages)</li>\n')
+        outfile.write('</ul>\n</body></html>\n')
+
+
+def get_logger():
+    logger = logging.getLogger('html-export')    
+    if not logger.handlers:
+        logger.setLevel(logging.DEBUG)
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        logger.addHandler(ch)
+    return logger
 
-        outfile.write('</div>\n')
 
+# renderer of a worker process in --all mode, set up by init_worker
+worker_renderer = None
 
+def init_worker(config_file, offline):
+    global worker_renderer
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    worker_renderer = HtmlRenderer(config, get_logger(), offline)
+
+def convert_worker(channel, files, options):
+    return convert(worker_renderer, channel, files, options)
+
+
+def convert(renderer, channel, files, options):
+    """Convert a channel the way the command line options ask for"""
+    if options.paged:
+        return convert_channel_paged(renderer, channel, files, options.build_dir,
+                                     options.incremental)
+    if options.incremental:
+        return convert_channel_incremental(renderer, channel, files, options.build_dir)
+    return convert_channel(renderer, channel, files)
+
+
+def main():
+
+    argparser_main = argparse.ArgumentParser()
+    argparser_main.add_argument('--config',
+                                help='Location of configuration file')
+    argparser_main.add_argument('-a', '--all', action='store_true',
+                                help='Convert all channels and write an index page')
+    argparser_main.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                                help='Number of channels converted in parallel with --all')
+    argparser_main.add_argument('-i', '--incremental', action='store_true',
+                                help='Only render the months whose history files changed')
+    argparser_main.add_argument('-p', '--paged', action='store_true',
+                                help='Write one page per month and a JSON index of the months')
+    argparser_main.add_argument('--offline', action='store_true',
+                                help='Do not download missing attachments')
+    argparser_main.add_argument('--build-dir', default='html-build',
+                                help='Where --incremental and --paged keep the rendered months')
+    
+    argparser_main.add_argument('channel', nargs='?',
+                                help='Name of the channel to export')
+
+    args = argparser_main.parse_args()
+
+    if not args.all and not args.channel:
+        argparser_main.error('give a channel name or --all')
+
+    logger = get_logger()
+
+    config_file = args.config if args.config else 'settings.cfg'
+    config = configparser.ConfigParser()
+    config.read( config_file )
+
+    input_dir = config['files']['history_output_dir']
+
+    logger.debug("Input folder: "+input_dir)
+
+    index = index_history_dir(input_dir)
+
+    if not args.all:
+        files = index.get(args.channel, [])
+        count = 0
+        if len(files) > 0:
+            count = convert(HtmlRenderer(config, logger, args.offline), args.channel, files, args)
+        if count == 0:
+            print("No messages found for channel: "+args.channel)
+        return
 
+    # every channel is rendered in a process of its own, as rendering
+    # is CPU bound
+    channels = []
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                initializer=init_worker,
+                                                initargs=(config_file, args.offline)) as pool:
+        futures = {pool.submit(convert_worker, channel, files, args): channel
+                   for channel, files in index.items()}
+        for future in concurrent.futures.as_completed(futures):
+            channel = futures[future]
+            try:
+                count = future.result()
+            except Exception:
+                logger.exception('Failed to convert channel: ' + channel)
+                failed.append(channel)
+                continue
+            logger.info('Converted %s (%d messages)', channel, count)
+            channels.append((channel, count))
+
+    write_index(sorted(channels))
+    logger.info('Converted %d channels', len(channels))
+
+    if failed:
+        raise SystemExit('Failed to convert channels: ' + ', '.join(sorted(failed)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,202 @@
+"""
+
+Description:
+    Indexes the history files written by export-history.py into an
+    SQLite database with a full-text index (FTS5) over the message text,
+    and searches it
+
+Dependencies:
+    Python's sqlite3 module, built with FTS5 (true for most builds)
+
+
+Commands:
+    pipenv run python search-history.py index
+    pipenv run python search-history.py search 'deploy AND friday'
+    pipenv run python search-history.py search --room general --user alice 'release*'
+
+"""
+
+import os
+import sqlite3
+import logging
+import argparse
+import configparser
+from history_common import index_history_dir, load_history_file
+
+
+class MessageIndex:
+    """Messages of all history files in an SQLite database.
+
+    Messages are keyed on their '_id', so a message that is indexed again
+    (from a file that changed, or from another file of the same window) is
+    updated instead of added twice. The 'files' table records size and
+    mtime of every indexed file; update() only reads files that changed
+    since. 'messages_fts' is an FTS5 index over the message text, kept in
+    sync with 'messages' by triggers.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            name TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            rid TEXT,
+            room TEXT NOT NULL,
+            ts TEXT NOT NULL,
+            username TEXT,
+            name TEXT,
+            tmid TEXT,
+            msg TEXT,
+            file TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_room ON messages (room, ts);
+        CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+        CREATE INDEX IF NOT EXISTS messages_user ON messages (username, ts);
+        CREATE INDEX IF NOT EXISTS messages_tmid ON messages (tmid);
+        CREATE INDEX IF NOT EXISTS messages_file ON messages (file);
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+            msg, content='messages', content_rowid='rowid'
+        );
+        CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, msg) VALUES (new.rowid, new.msg);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, msg) VALUES ('delete', old.rowid, old.msg);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, msg) VALUES ('delete', old.rowid, old.msg);
+            INSERT INTO messages_fts (rowid, msg) VALUES (new.rowid, new.msg);
+        END;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+
+    def update(self, input_dir, logger):
+        """Index the history files in input_dir that are new or changed.
+        Returns the number of files read."""
+        known = {name: (size, mtime) for name, size, mtime
+                 in self.db.execute('SELECT name, size, mtime FROM files')}
+        updated = 0
+
+        for room, files in sorted(index_history_dir(input_dir).items()):
+            for _, filename in files:
+                st = os.stat(input_dir + filename)
+                if known.get(filename) == (st.st_size, st.st_mtime_ns):
+                    continue
+
+                messages = load_history_file(input_dir + filename)
+
+                # one transaction per file, so an interrupted run leaves
+                # no file half indexed
+                self.db.execute('BEGIN')
+                self.db.execute('DELETE FROM messages WHERE file = ?', (filename,))
+                self.db.executemany(
+                    'INSERT INTO messages (id, rid, room, ts, username, name, tmid, msg, file) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (id) DO UPDATE SET rid = excluded.rid, room = excluded.room, '
+                    'ts = excluded.ts, username = excluded.username, name = excluded.name, '
+                    'tmid = excluded.tmid, msg = excluded.msg, file = excluded.file',
+                    [(m.get('_id'), m.get('rid'), room, m['ts'],
+                      m.get('u', {}).get('username'), m.get('u', {}).get('name'),
+                      m.get('tmid'), m.get('msg', ''), filename)
+                     for m in messages if '_id' in m])
+                self.db.execute('INSERT OR REPLACE INTO files (name, size, mtime) VALUES (?, ?, ?)',
+                                (filename, st.st_size, st.st_mtime_ns))
+                self.db.execute('COMMIT')
+
+                logger.debug('Indexed %s (%d messages)', filename, len(messages))
+                updated += 1
+
+        return updated
+
+    def search(self, query, room=None, user=None, since=None, until=None, limit=50):
+        """Messages matching the FTS5 query, newest first, as
+        (ts, room, username, snippet) rows"""
+        sql = ("SELECT m.ts, m.room, m.username, snippet(messages_fts, 0, '[', ']', '...', 16) "
+               "FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid "
+               "WHERE messages_fts MATCH ?")
+        params = [query]
+
+        if room:
+            sql += ' AND m.room = ?'
+            params.append(room)
+        if user:
+            sql += ' AND m.username = ?'
+            params.append(user)
+        if since:
+            sql += ' AND m.ts >= ?'
+            params.append(since)
+        if until:
+            sql += ' AND m.ts < ?'
+            params.append(until)
+
+        sql += ' ORDER BY m.ts DESC LIMIT ?'
+        params.append(limit)
+        return self.db.execute(sql, params).fetchall()
+
+
+def main():
+
+    argparser_main = argparse.ArgumentParser()
+    argparser_main.add_argument('--config',
+                                help='Location of configuration file')
+    subparsers = argparser_main.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('index',
+                          help='Add new and changed history files to the index')
+
+    argparser_search = subparsers.add_parser('search',
+                                             help='Search the index (FTS5 query syntax)')
+    argparser_search.add_argument('query')
+    argparser_search.add_argument('-r', '--room', help='Only messages of this room')
+    argparser_search.add_argument('-u', '--user', help='Only messages of this username')
+    argparser_search.add_argument('-s', '--since', help='Only messages from this date on (YYYY-MM-DD)')
+    argparser_search.add_argument('-e', '--until', help='Only messages before this date (YYYY-MM-DD)')
+    argparser_search.add_argument('-n', '--limit', type=int, default=50,
+                                  help='Maximum number of results')
+
+    args = argparser_main.parse_args()
+
+    logger = logging.getLogger('search-history')
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    logger.addHandler(ch)
+
+    config = configparser.ConfigParser()
+    config.read( args.config if args.config else 'settings.cfg' )
+
+    input_dir = config['files']['history_output_dir']
+    search_db = config.get('files', 'search_db', fallback='history-search.sqlite')
+
+    index = MessageIndex(search_db)
+
+    if args.command == 'index':
+        logger.debug("Input folder: "+input_dir)
+        updated = index.update(input_dir, logger)
+        logger.info('%d history files indexed', updated)
+        return
+
+    try:
+        results = index.search(args.query, room=args.room, user=args.user,
+                               since=args.since, until=args.until, limit=args.limit)
+    except sqlite3.OperationalError as err:
+        raise SystemExit('Invalid search query: ' + str(err))
+
+    for ts, room, username, snippet in results:
+        print(ts[:10] + ' ' + ts[11:19] + ' #' + room + ' ' + str(username) + ': '
+              + ' '.join(snippet.split()))
+    if not results:
+        print('No messages found')
+
+
+if __name__ == "__main__":
+    main()